@@ -0,0 +1,168 @@
+"""
+批量转换命令行工具
+
+用法示例:
+    python batch.py frames/ -o out/ -p "pixelate, keep ratio, cv2 4-level, red/green" -j 8
+    python batch.py "shots/*.png" -o out/
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import processing
+from cache import ResultCache, make_key
+from convert import encode_image
+
+# 与界面中"选择图片"支持的格式一致
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp")
+
+
+def collect_sources(inputs):
+    # 展开目录和通配符, 返回 (源文件, 相对输出路径) 列表, 保证每个源文件的输出文件名不重复
+    sources = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        sources.append((path, os.path.relpath(path, pattern)))
+        else:
+            for path in sorted(glob.glob(pattern)):
+                if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                    sources.append((path, os.path.basename(path)))
+    return unique_outputs(sources)
+
+
+def _output_stem(relative):
+    return os.path.normcase(os.path.splitext(relative)[0])
+
+
+def unique_outputs(sources):
+    # 输出文件名只取源文件名去掉扩展名的部分, 以下情况会写到同一个输出文件:
+    # - 几个通配符匹配到同一个文件: 只保留一次
+    # - 同名不同扩展名, 例如 a.png 和 a.jpg: 输出文件名保留源扩展名, 即 a.png.png 和 a.jpg.png
+    # 仍然重名时(例如不同目录中的同名文件)报错, 不让多个进程同时写同一个文件
+    seen = set()
+    unique = []
+    for source, relative in sources:
+        real = os.path.normcase(os.path.realpath(source))
+        if real not in seen:
+            seen.add(real)
+            unique.append((source, relative))
+    counts = {}
+    for _, relative in unique:
+        counts[_output_stem(relative)] = counts.get(_output_stem(relative), 0) + 1
+    renamed = []
+    for source, relative in unique:
+        if counts[_output_stem(relative)] > 1:
+            relative += os.path.splitext(relative)[1]
+        renamed.append((source, relative))
+    destinations = {}
+    for source, relative in renamed:
+        other = destinations.setdefault(_output_stem(relative), source)
+        if other != source:
+            raise ValueError(f"输出文件名冲突: {other} 和 {source}")
+    return renamed
+
+
+def output_path(out_dir, relative, fmt):
+    return os.path.join(out_dir, os.path.splitext(relative)[0] + "." + fmt)
+
+
+# 每个工作进程各自的结果缓存, 磁盘缓存目录在进程间共享
+_cache = None
+
+
+def init_worker(cache_dir):
+    global _cache
+    if cache_dir:
+        _cache = ResultCache(disk_dir=cache_dir)
+
+
+def convert_file(source, destination, pipeline, fmt="png"):
+    # 在工作进程中完成读取、处理和写入, 只把状态传回主进程
+    start = time.perf_counter()
+    try:
+        with open(source, "rb") as f:
+            data = f.read()
+        key = make_key(data, pipeline, fmt)
+        encoded = _cache.get(key) if _cache else None
+        cached = encoded is not None
+        if not cached:
+            encoded = encode_image(data, pipeline, fmt)
+            if _cache:
+                _cache.put(key, encoded)
+        os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+        with open(destination, "wb") as f:
+            f.write(encoded)
+        return source, destination, None, cached, time.perf_counter() - start
+    except Exception as e:
+        return source, destination, f"{type(e).__name__}: {e}", False, time.perf_counter() - start
+
+
+def run_batch(sources, out_dir, pipeline, workers=None, fmt="png", max_pending=None, cache_dir=None, report=print):
+    # 用进程池并行转换, 同时在途的任务数有上限, 避免一次性提交上千个任务占用内存
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    ok = failed = hits = 0
+    start = time.perf_counter()
+    jobs = iter(sources)
+    pending = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_dir,)) as executor:
+        while True:
+            for source, relative in jobs:
+                pending.add(executor.submit(convert_file, source, output_path(out_dir, relative, fmt), pipeline, fmt))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, destination, error, cached, elapsed = future.result()
+                if error is None:
+                    ok += 1
+                    hits += cached
+                    report(f"[{'hit' if cached else 'ok'}]{' ' if cached else '  '} {source} -> {destination} ({elapsed * 1000:.1f} ms)")
+                else:
+                    failed += 1
+                    report(f"[fail] {source}: {error}")
+    elapsed = time.perf_counter() - start
+    return {"ok": ok, "failed": failed, "cache_hits": hits, "seconds": elapsed,
+            "files_per_second": (ok + failed) / elapsed if elapsed else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量将图片转换为计算器屏幕格式")
+    parser.add_argument("inputs", nargs="+", help="图片目录或通配符")
+    parser.add_argument("-o", "--output", required=True, help="输出目录")
+    parser.add_argument("-p", "--pipeline", default="pixelate, keep ratio, 4-level",
+                        help='处理流程, 例如 "pixelate, keep ratio, cv2 4-level, red/green"')
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数, 默认等于 CPU 核心数")
+    parser.add_argument("--cache-dir", default=None, help="结果缓存目录, 相同图片和参数再次转换时直接复用")
+    parser.add_argument("-f", "--format", default="png", choices=["png", "bmp", "jpg", "cgb"],
+                        help="输出格式, cgb 为计算器位图(见 bitplane.py)")
+    args = parser.parse_args(argv)
+
+    try:
+        pipeline = processing.parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        sources = collect_sources(args.inputs)
+    except ValueError as e:
+        parser.error(str(e))
+    if not sources:
+        parser.error("没有找到图片")
+
+    summary = run_batch(sources, args.output, pipeline, args.workers, args.format, cache_dir=args.cache_dir)
+    print(f"完成: {summary['ok']} 成功 (缓存命中 {summary['cache_hits']}), {summary['failed']} 失败, "
+          f"用时 {summary['seconds']:.2f} s, {summary['files_per_second']:.1f} 张/秒")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
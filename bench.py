@@ -0,0 +1,256 @@
+"""
+各处理步骤的性能测试
+
+对不同大小的合成图片(以及 --fixtures 指定目录中的图片)分别测量
+解码、像素化、各种灰度化和抖动、红绿模式、像素分割线、编码的耗时和峰值内存,
+结果写成 JSON, 可以用 --compare 对比两次提交之间的差异
+另外测量冷启动: 新开解释器导入各入口模块、以及用 python -m convert 转换一张图片的总耗时
+
+用法示例:
+    python bench.py -o bench.json
+    python bench.py --sizes 192x63,1920x1080 --repeat 3
+    python bench.py --compare old.json new.json
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+import processing
+import loader
+import bitplane
+import stages as stage_cache
+
+DEFAULT_SIZES = "192x63,640x480,1920x1080,4000x3000,7680x4320"
+
+# 冷启动测量的入口模块, 命令行脚本每次调用都要付出导入的时间
+STARTUP_MODULES = ("processing", "convert", "batch", "stream", "server", "main")
+
+
+def synthetic_image(width, height, seed=0):
+    # 固定种子的合成图片: 渐变 + 色块 + 噪声, 保证每次运行内容相同
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    rgb[..., 0] = (x * 255 // max(width - 1, 1))
+    rgb[..., 1] = (y * 255 // max(height - 1, 1))
+    rgb[..., 2] = ((x // max(width // 8, 1) + y // max(height // 8, 1)) % 2) * 200
+    noise = rng.integers(0, 32, size=(height, width, 1), dtype=np.uint8)
+    return rgb + np.minimum(noise, 255 - rgb.max(axis=2, keepdims=True))
+
+
+def measure(func, repeat):
+    # 返回 (各次耗时毫秒列表, 峰值内存 KB), 峰值内存单独跑一次测量, 不影响计时
+    # tracemalloc 只能统计到 Python 和 NumPy 的分配, Pillow 内部的图像缓冲区按解码结果的大小补上
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    out = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if isinstance(out, loader.LoadResult):
+        peak = max(peak, out.peak_bytes)
+    elif isinstance(out, Image.Image):
+        peak = max(peak, out.width * out.height * len(out.getbands()))
+    return times, peak / 1024
+
+
+def _decode_full(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+def _rerun_quantizer(pixelated):
+    memo = stage_cache.StagePipeline()
+    memo.seed("pixelate", processing.Pipeline(), pixelated)
+    return memo.run(processing.Pipeline(method="cv2"))
+
+
+def stages(rgb, source_bytes):
+    # (步骤名, 无参函数) 列表, 每一步的输入都提前准备好, 只测量这一步本身
+    pixelated = processing.pixelate(rgb, True)
+    levels = processing.quantize_4level_cv2(pixelated)
+    rendered = processing.render(levels)
+    pixel_buffer = np.empty_like(pixelated)
+    result = []
+    for name, data in source_bytes.items():
+        result.append((f"decode_full_{name}", lambda data=data: _decode_full(data)))
+        result.append((f"decode_shrink_{name}", lambda data=data: loader.load_image(data, rotatable=False)))
+    result += [
+        ("pixelate_keep_ratio", lambda: processing.pixelate(rgb, True)),
+        ("pixelate_stretch", lambda: processing.pixelate(rgb, False)),
+        # 连续处理同样大小的帧: 缩放计划取缓存, 结果写入同一块缓冲区
+        ("pixelate_into_buffer", lambda: processing.pixelate(rgb, True, out=pixel_buffer)),
+        ("pixelate_384x216", lambda: processing.pixelate(rgb, True, "384x216")),
+    ]
+    for method, quantize in processing.QUANTIZERS.items():
+        result.append((f"quantize_{method}", lambda quantize=quantize: quantize(pixelated)))
+    # 抖动与上面的直接量化对比, 四级和二级各测一次
+    for dither in processing.DITHERS[1:]:
+        for method in ("cv2", "2level"):
+            result.append((f"dither_{dither}_{method}",
+                           lambda dither=dither, method=method: processing.quantize(pixelated, method, dither)))
+    # 分阶段缓存: 切换红绿模式直接取缓存; 换灰度化方式时复用像素化结果, 只算灰度化和上色
+    memo = stage_cache.StagePipeline()
+    memo.set_source(rgb)
+    memo.run(processing.Pipeline(method="cv2"))
+    result += [
+        ("stage_toggle_red_green", lambda: memo.run(processing.Pipeline(method="cv2", red_green_mode=True))),
+        ("stage_change_quantizer", lambda: _rerun_quantizer(pixelated)),
+        ("render_gray", lambda: processing.render(levels)),
+        ("render_red_green", lambda: processing.render(levels, True)),
+        ("red_green_rgb", lambda: processing.red_green(rendered)),
+        ("grid", lambda: processing.grid(rendered)),
+        ("encode_png", lambda: Image.fromarray(rendered).save(io.BytesIO(), format="PNG")),
+        ("encode_cgb", lambda: bitplane.encode(levels)),
+    ]
+    return result
+
+
+def encode_sources(rgb):
+    # 解码测试用的 JPEG 和 PNG 字节
+    sources = {}
+    for fmt in ("JPEG", "PNG"):
+        buffer = io.BytesIO()
+        Image.fromarray(rgb).save(buffer, format=fmt)
+        sources[fmt.lower()] = buffer.getvalue()
+    return sources
+
+
+def load_fixtures(directory):
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        if path.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")):
+            with open(path, "rb") as f:
+                data = f.read()
+            with Image.open(io.BytesIO(data)) as img:
+                rgb = processing.to_rgb_array(img)
+            fmt = "jpeg" if path.lower().endswith((".jpg", ".jpeg")) else "file"
+            yield os.path.basename(path), rgb, {fmt: data}
+
+
+def _run_python(args):
+    # 新开解释器运行, 返回耗时毫秒, 失败(例如缺少依赖)时返回 None
+    start = time.perf_counter()
+    done = subprocess.run([sys.executable] + args, capture_output=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = (time.perf_counter() - start) * 1000
+    return elapsed if done.returncode == 0 else None
+
+
+def startup_costs(repeat, report=print):
+    # 冷启动耗时: 空解释器, 导入各入口模块, 以及命令行转换一张 1920x1080 的 JPEG
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = os.path.join(tmp, "sample.jpg")
+        Image.fromarray(synthetic_image(1920, 1080)).save(sample)
+        commands = [("python", ["-c", "pass"])]
+        commands += [(f"import_{module}", ["-c", f"import {module}"]) for module in STARTUP_MODULES]
+        commands.append(("convert_cli", ["-m", "convert", sample, "-o", os.path.join(tmp, "out.cgb")]))
+        results = []
+        for stage, args in commands:
+            times = [_run_python(args) for _ in range(repeat)]
+            if None in times:
+                report(f"{'startup':>24} {stage:<22} 失败, 跳过")
+                continue
+            results.append({"image": "startup", "width": 0, "height": 0, "stage": stage,
+                            "median_ms": statistics.median(times), "min_ms": min(times), "peak_kb": None})
+            report(f"{'startup':>24} {stage:<22} {statistics.median(times):10.3f} ms")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(sizes, repeat, fixtures=None, report=print, startup=True):
+    images = []
+    for size in sizes:
+        width, height = map(int, size.lower().split("x"))
+        rgb = synthetic_image(width, height)
+        images.append((f"synthetic-{width}x{height}", rgb, encode_sources(rgb)))
+    if fixtures:
+        images.extend(load_fixtures(fixtures))
+
+    results = startup_costs(repeat, report) if startup else []
+    for name, rgb, source_bytes in images:
+        for stage, func in stages(rgb, source_bytes):
+            times, peak_kb = measure(func, repeat)
+            row = {"image": name, "width": rgb.shape[1], "height": rgb.shape[0], "stage": stage,
+                   "median_ms": statistics.median(times), "min_ms": min(times), "peak_kb": round(peak_kb, 1)}
+            results.append(row)
+            report(f"{name:>24} {stage:<22} {row['median_ms']:10.3f} ms {row['peak_kb']:12.1f} KB")
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(old, new, threshold=1.2, report=print):
+    # 对比两次结果, 返回变慢超过 threshold 倍的步骤数
+    old_rows = {(r["image"], r["stage"]): r for r in old["results"]}
+    regressions = 0
+    report(f"{old.get('commit')} -> {new.get('commit')}")
+    for row in new["results"]:
+        before = old_rows.get((row["image"], row["stage"]))
+        if before is None or not before["median_ms"]:
+            continue
+        ratio = row["median_ms"] / before["median_ms"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- 变慢"
+            regressions += 1
+        report(f"{row['image']:>24} {row['stage']:<22} {before['median_ms']:10.3f} -> {row['median_ms']:10.3f} ms "
+               f"x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图片处理各步骤的性能测试")
+    parser.add_argument("-o", "--output", help="结果 JSON 文件")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="合成图片大小, 逗号分隔, 例如 192x63,1920x1080")
+    parser.add_argument("--fixtures", help="额外测试的图片目录")
+    parser.add_argument("--repeat", type=int, default=5, help="每一步重复次数, 取中位数")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两个结果文件")
+    parser.add_argument("--threshold", type=float, default=1.2, help="对比时认为变慢的倍数")
+    parser.add_argument("--skip-startup", action="store_true", help="不测量冷启动耗时")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.compare[1], encoding="utf-8") as f:
+            new = json.load(f)
+        return 1 if compare(old, new, args.threshold) else 0
+
+    data = run([s for s in args.sizes.split(",") if s], args.repeat, args.fixtures, startup=not args.skip_startup)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+计算器位图格式(.cgb)
+
+把四级灰度结果保存为两个位平面(二级灰度为一个), 192x63 的四级灰度图只需 3 KB 左右,
+计算器端按位平面直接拷进显存即可, 不需要再做任何转换
+
+文件格式(小端):
+    头部 8 字节: b"CG", uint8 版本号(1), uint8 位平面数(1 或 2), uint16 宽, uint16 高
+    之后依次为各个位平面, 每个位平面 高 x ceil(宽/8) 字节,
+    逐行存放, 每字节 8 个像素, 最高位为最左边的像素, 行末不足 8 个像素时补 0
+
+位平面含义(1 表示对应像素点亮):
+    二级灰度: 平面 0 为黑色像素
+    四级灰度: 平面 0 为"浅"平面, 平面 1 为"深"平面, 与常见灰度引擎的 light/dark 显存一致
+        白色       -> 浅 0, 深 0
+        #BABABA    -> 浅 1, 深 0
+        #959595    -> 浅 0, 深 1
+        黑色       -> 浅 1, 深 1
+"""
+import struct
+
+import numpy as np
+
+MAGIC = b"CG"
+VERSION = 1
+_HEADER = struct.Struct("<2sBBHH")
+
+
+def is_two_level(levels: np.ndarray) -> bool:
+    # 只有黑白两色时可以只用一个位平面
+    return not np.isin(levels, (1, 2)).any()
+
+
+def choose_planes(levels: np.ndarray, planes: int = None) -> int:
+    # planes 为 None 时根据内容自动选择位平面数
+    if planes is None:
+        planes = 1 if is_two_level(levels) else 2
+    if planes == 1 and not is_two_level(levels):
+        raise ValueError("图片中有灰色像素, 不能保存为二级灰度")
+    return planes
+
+
+def planes_size(width: int, height: int, planes: int) -> int:
+    # 位平面部分的字节数
+    return -(-width // 8) * height * planes
+
+
+def encode_planes(levels: np.ndarray, planes: int) -> bytes:
+    # 色阶索引 -> 位平面字节(不含头部)
+    # 色阶 0(黑)~3(白) 转为深度 3(黑)~0(白)
+    darkness = 3 - levels.astype(np.uint8)
+    if planes == 1:
+        bitplanes = [darkness >> 1]
+    else:
+        bitplanes = [darkness & 1, darkness >> 1]
+    return b"".join(np.packbits(plane, axis=1).tobytes() for plane in bitplanes)
+
+
+def decode_planes(body, width: int, height: int, planes: int) -> np.ndarray:
+    # 位平面字节(bytes、memoryview 或 uint8 数组) -> 色阶索引
+    row_bytes = -(-width // 8)
+    plane_bytes = row_bytes * height
+    body = np.frombuffer(body, dtype=np.uint8, count=plane_bytes * planes)
+    bitplanes = [np.unpackbits(body[i * plane_bytes:(i + 1) * plane_bytes].reshape(height, row_bytes),
+                               axis=1, count=width) for i in range(planes)]
+    if planes == 1:
+        darkness = bitplanes[0] * 3
+    else:
+        darkness = bitplanes[0] | bitplanes[1] << 1
+    return (3 - darkness).astype(np.uint8)
+
+
+def encode(levels: np.ndarray, planes: int = None) -> bytes:
+    # 色阶索引 -> .cgb 字节, planes 为 None 时根据内容自动选择
+    planes = choose_planes(levels, planes)
+    height, width = levels.shape
+    return _HEADER.pack(MAGIC, VERSION, planes, width, height) + encode_planes(levels, planes)
+
+
+def decode(data: bytes) -> np.ndarray:
+    # .cgb 字节 -> 色阶索引
+    magic, version, planes, width, height = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or planes not in (1, 2):
+        raise ValueError("不是有效的 .cgb 文件")
+    body = memoryview(data)[_HEADER.size:_HEADER.size + planes_size(width, height, planes)]
+    return decode_planes(body, width, height, planes)
+
+
+def save(path, levels: np.ndarray, planes: int = None):
+    with open(path, "wb") as f:
+        f.write(encode(levels, planes))
+
+
+def load(path) -> np.ndarray:
+    with open(path, "rb") as f:
+        return decode(f.read())
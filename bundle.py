@@ -0,0 +1,346 @@
+"""
+多图资源包(.cgbp)
+
+游戏和幻灯片要用到成百上千张转换好的图片, 打包成一个文件, 附带索引:
+- 每张图片按 .cgb 的位平面格式保存(见 bitplane.py), 二级灰度 1 个位平面, 四级灰度 2 个
+- 可选游程编码(RLE), 只在确实变小时使用
+- 读取时用 mmap 映射整个文件, 打开时只读固定大小的头部, 与图片数量无关;
+  索引、名称和图片数据都是文件映射上的零拷贝视图, 用到哪张才读哪张
+
+用法示例:
+    python bundle.py build sprites.cgbp sprites/ -p "pixelate, keep ratio, 2-level"
+    python bundle.py list sprites.cgbp
+    python bundle.py extract sprites.cgbp title -o title.png
+
+文件格式(小端):
+    头部 32 字节: b"CGBP", uint8 版本号(1), 3 字节保留, uint32 图片数,
+                  uint64 索引偏移, uint64 名称表偏移, uint32 名称排序表偏移(相对名称表)
+    图片数据: 依次存放, 未压缩时即各位平面, 与 .cgb 去掉头部后相同
+    索引: 每张图片 32 字节, 按写入顺序排列, 字段见 INDEX_DTYPE
+    名称表: 所有名称的 UTF-8 字节依次相连, 之后 4 字节对齐, 接着是按名称排序后的图片序号(uint32 数组),
+            按名称查找时在其上二分查找
+
+RLE 编码: 若干个 (uint8 重复次数 1~255, uint8 字节值) 对, 解码后即未压缩的位平面
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+import bitplane
+
+MAGIC = b"CGBP"
+VERSION = 1
+_HEADER = struct.Struct("<4sB3xIQQI")
+
+FLAG_RLE = 1
+
+INDEX_DTYPE = np.dtype([
+    ("name_offset", "<u4"),  # 名称在名称表中的偏移
+    ("name_size", "<u2"),  # 名称的字节数
+    ("planes", "u1"),  # 位平面数, 1 或 2
+    ("flags", "u1"),  # FLAG_RLE
+    ("width", "<u2"),
+    ("height", "<u2"),
+    ("offset", "<u8"),  # 图片数据在文件中的偏移
+    ("size", "<u4"),  # 图片数据的字节数(压缩后)
+    ("raw_size", "<u4"),  # 未压缩的位平面字节数
+    ("reserved", "<u4"),
+])
+assert INDEX_DTYPE.itemsize == 32
+
+
+class Entry(NamedTuple):
+    # 资源包中的一张图片
+    index: int
+    name: str
+    width: int
+    height: int
+    planes: int
+    compressed: bool
+    offset: int
+    size: int
+
+
+def rle_encode(data: bytes) -> bytes:
+    # 相同字节连续出现时合并为 (次数, 字节值), 超过 255 次时拆开
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if not len(buf):
+        return b""
+    starts = np.flatnonzero(np.concatenate(([True], buf[1:] != buf[:-1])))
+    lengths = np.diff(np.append(starts, len(buf)))
+    # 长度超过 255 的游程拆成多段
+    pieces = -(-lengths // 255)
+    values = np.repeat(buf[starts], pieces)
+    counts = np.full(pieces.sum(), 255, dtype=np.int64)
+    ends = np.cumsum(pieces) - 1
+    counts[ends] = lengths - (pieces - 1) * 255
+    return np.stack([counts.astype(np.uint8), values], axis=1).tobytes()
+
+
+def rle_decode(data, raw_size: int) -> np.ndarray:
+    pairs = np.frombuffer(data, dtype=np.uint8).reshape(-1, 2)
+    out = np.repeat(pairs[:, 1], pairs[:, 0])
+    if len(out) != raw_size:
+        raise ValueError("RLE 数据已损坏")
+    return out
+
+
+class BundleWriter:
+    # 边转换边写入, 图片数据直接写进文件, 内存中只保留索引
+    # 先写同一目录下的临时文件, 完整写完后再替换 path, 中途出错不会留下或破坏资源包
+    def __init__(self, path, compress=True):
+        # compress: 是否尝试 RLE, 只有压缩后更小的图片才会压缩
+        self.path = path
+        self.compress = compress
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0))
+        self._records = []
+        self._names = []
+        self._seen = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def add(self, name: str, levels: np.ndarray, planes: int = None):
+        # 加入一张图片, levels 为色阶索引, planes 为 None 时根据内容自动选择位平面数
+        if name in self._seen:
+            raise ValueError(f"重复的图片名称: {name}")
+        planes = bitplane.choose_planes(levels, planes)
+        height, width = levels.shape
+        if width > 0xFFFF or height > 0xFFFF:
+            raise ValueError(f"图片太大: {width}x{height}")
+        raw = bitplane.encode_planes(levels, planes)
+        data, flags = raw, 0
+        if self.compress:
+            packed = rle_encode(raw)
+            if len(packed) < len(raw):
+                data, flags = packed, FLAG_RLE
+        encoded_name = name.encode("utf-8")
+        record = np.zeros((), dtype=INDEX_DTYPE)
+        record["name_offset"] = sum(len(n) for n in self._names)
+        record["name_size"] = len(encoded_name)
+        record["planes"] = planes
+        record["flags"] = flags
+        record["width"] = width
+        record["height"] = height
+        record["offset"] = self._file.tell()
+        record["size"] = len(data)
+        record["raw_size"] = len(raw)
+        self._file.write(data)
+        self._records.append(record)
+        self._names.append(encoded_name)
+        self._seen.add(name)
+
+    def close(self):
+        # 写出索引和名称表, 再回填头部
+        if self._file.closed:
+            return
+        f = self._file
+        index_offset = f.tell()
+        f.write(np.array(self._records, dtype=INDEX_DTYPE).tobytes())
+        names_offset = f.tell()
+        names = b"".join(self._names)
+        f.write(names)
+        padding = -len(names) % 4
+        f.write(b"\0" * padding)
+        order = sorted(range(len(self._names)), key=self._names.__getitem__)
+        f.write(np.array(order, dtype="<u4").tobytes())
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, len(self._records), index_offset, names_offset, len(names) + padding))
+        f.close()
+        os.replace(self._tmp, self.path)
+
+    def discard(self):
+        # 放弃写入, 删除临时文件, 已有的资源包保持不变
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self._tmp)
+
+
+def write_bundle(path, items, compress=True) -> int:
+    # items 为 (名称, 色阶索引) 序列, 返回写入的图片数
+    count = 0
+    with BundleWriter(path, compress) as writer:
+        for name, levels in items:
+            writer.add(name, levels)
+            count += 1
+    return count
+
+
+class Bundle:
+    # 用 mmap 读取资源包, 按序号或名称取图片
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset, names_offset, order_offset = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError("不是有效的资源包文件")
+        self._index = np.frombuffer(self._map, dtype=INDEX_DTYPE, count=count, offset=index_offset)
+        self._order = np.frombuffer(self._map, dtype="<u4", count=count, offset=names_offset + order_offset)
+        self._names_offset = names_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def close(self):
+        self._index = self._order = None
+        try:
+            self._map.close()
+        except BufferError:
+            # 还有取出的图片视图在使用, 映射由垃圾回收释放
+            pass
+
+    def _name(self, i: int) -> bytes:
+        record = self._index[i]
+        start = self._names_offset + int(record["name_offset"])
+        return self._map[start:start + int(record["name_size"])]
+
+    def _find(self, name: str):
+        # 在按名称排序的序号表上二分查找, 只读取比较到的几个名称
+        key = name.encode("utf-8")
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(int(self._order[mid])) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._order) and self._name(int(self._order[lo])) == key:
+            return int(self._order[lo])
+        return None
+
+    def _resolve(self, key) -> int:
+        if isinstance(key, str):
+            index = self._find(key)
+            if index is None:
+                raise KeyError(key)
+            return index
+        index = int(key)
+        if not -len(self) <= index < len(self):
+            raise IndexError(key)
+        return index % len(self)
+
+    def entry(self, key) -> Entry:
+        i = self._resolve(key)
+        record = self._index[i]
+        return Entry(i, self._name(i).decode("utf-8"), int(record["width"]), int(record["height"]),
+                     int(record["planes"]), bool(record["flags"] & FLAG_RLE),
+                     int(record["offset"]), int(record["size"]))
+
+    def names(self):
+        # 按写入顺序生成全部名称
+        for i in range(len(self)):
+            yield self._name(i).decode("utf-8")
+
+    def planes(self, key) -> np.ndarray:
+        # 位平面数据, (位平面数, 高, ceil(宽/8)) 的 uint8 数组
+        # 未压缩时是文件映射上的只读视图, 不复制; RLE 压缩的图片需要解码, 返回新数组
+        entry = self.entry(key)
+        raw_size = int(self._index[entry.index]["raw_size"])
+        if entry.compressed:
+            data = rle_decode(self._map[entry.offset:entry.offset + entry.size], raw_size)
+        else:
+            data = np.frombuffer(self._map, dtype=np.uint8, count=raw_size, offset=entry.offset)
+        return data.reshape(entry.planes, entry.height, -(-entry.width // 8))
+
+    def levels(self, key) -> np.ndarray:
+        # 解码为色阶索引
+        entry = self.entry(key)
+        return bitplane.decode_planes(self.planes(key), entry.width, entry.height, entry.planes)
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.levels(key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把多张图片打包为计算器资源包")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="转换图片并打包")
+    build.add_argument("output", help="资源包文件")
+    build.add_argument("inputs", nargs="+", help="图片目录或通配符")
+    build.add_argument("-p", "--pipeline", default="pixelate, keep ratio, 4-level",
+                       help='处理流程, 例如 "pixelate, keep ratio, 2-level"')
+    build.add_argument("--no-rle", action="store_true", help="不使用游程编码")
+    listing = commands.add_parser("list", help="列出资源包中的图片")
+    listing.add_argument("bundle")
+    extract = commands.add_parser("extract", help="取出一张图片")
+    extract.add_argument("bundle")
+    extract.add_argument("name", help="图片名称")
+    extract.add_argument("-o", "--output", required=True, help="输出文件, .cgb 或图片格式")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        # 只有打包时才需要解码图片
+        import processing
+        from batch import collect_sources
+        from convert import decode_levels
+        try:
+            pipeline = processing.parse_pipeline(args.pipeline)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            sources = collect_sources(args.inputs)
+        except ValueError as e:
+            parser.error(str(e))
+        if not sources:
+            parser.error("没有找到图片")
+        start = time.perf_counter()
+        failed = 0
+        with BundleWriter(args.output, compress=not args.no_rle) as writer:
+            for source, relative in sources:
+                # 单张图片无法解码时跳过它, 其余图片照常打包
+                try:
+                    with open(source, "rb") as f:
+                        levels = decode_levels(f.read(), pipeline)
+                    writer.add(os.path.splitext(relative)[0].replace(os.sep, "/"), levels)
+                except Exception as e:
+                    failed += 1
+                    print(f"[fail] {source}: {type(e).__name__}: {e}", file=sys.stderr)
+        print(f"打包 {len(sources) - failed} 张图片, 失败 {failed}, {os.path.getsize(args.output)} 字节, "
+              f"用时 {time.perf_counter() - start:.2f} s")
+        return 1 if failed else 0
+    elif args.command == "list":
+        with Bundle(args.bundle) as bundle:
+            for i in range(len(bundle)):
+                entry = bundle.entry(i)
+                print(f"{entry.name}\t{entry.width}x{entry.height}\t{entry.planes} 位平面\t"
+                      f"{entry.size} 字节{' (RLE)' if entry.compressed else ''}")
+    else:
+        with Bundle(args.bundle) as bundle:
+            levels = bundle.levels(args.name)
+        if args.output.lower().endswith(".cgb"):
+            bitplane.save(args.output, levels)
+        else:
+            import processing
+            from PIL import Image
+            Image.fromarray(processing.render(levels)).save(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
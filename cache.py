@@ -0,0 +1,175 @@
+"""
+按内容寻址的转换结果缓存
+
+缓存键 = 源文件字节的 sha256 + 规范化后的处理参数 + 输出格式,
+相同的图片用相同的参数再次转换时直接返回上次的结果, 跳过解码和灰度化
+分两级: 进程内的 LRU 内存缓存, 以及有总大小上限的磁盘缓存
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import processing
+
+# 本进程写入的量超过磁盘缓存上限的这个比例时, 重新统计整个目录的占用,
+# 多个进程共用一个缓存目录时, 总占用最多超出上限 进程数 x 这个比例
+DISK_RESCAN_FRACTION = 1 / 16
+
+# 缓存键最初只包含前四个参数, 之后新增的参数取默认值时不写入键,
+# 这样加入新参数之前生成的缓存仍然有效
+_ADDED_FIELDS = ("dither", "profile")
+
+
+def normalize_pipeline(pipeline: processing.Pipeline) -> str:
+    # 参数 -> 稳定的字符串, 对结果没有影响的参数统一成默认值
+    if pipeline.method == "2level":
+        # 二级灰度没有 #959595/#BABABA, 红绿模式不起作用
+        pipeline = pipeline._replace(red_green_mode=False)
+    params = pipeline._asdict()
+    for name in _ADDED_FIELDS:
+        if params[name] == processing.Pipeline._field_defaults[name]:
+            del params[name]
+    return ";".join(f"{name}={int(value) if isinstance(value, bool) else value}"
+                    for name, value in params.items())
+
+
+def make_key(data: bytes, pipeline: processing.Pipeline, variant: str = "png") -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    params = hashlib.sha256(f"{normalize_pipeline(pipeline)};{variant}".encode()).hexdigest()[:16]
+    return f"{digest}-{params}"
+
+
+class ResultCache:
+    def __init__(self, memory_bytes=64 * 1024 * 1024, disk_dir=None, disk_bytes=512 * 1024 * 1024):
+        # memory_bytes / disk_bytes 为两级缓存各自的大小上限, disk_dir 为 None 时只用内存缓存
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_used = sum(size for _, size, _ in self._disk_entries())
+            # 上次统计目录之后本进程写入的字节数
+            self._disk_written = 0
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key]
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._memory_put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._memory_put(key, data)
+        if self.disk_dir:
+            self._disk_put(key, data)
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+        if self.disk_dir:
+            for path, _, _ in self._disk_entries():
+                os.remove(path)
+            self._disk_used = 0
+
+    # -------------/ 内存缓存 /-------------
+    def _memory_put(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_used += len(data)
+        while self._memory_used > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_used -= len(old)
+            self.stats["evictions"] += 1
+
+    # -------------/ 磁盘缓存 /-------------
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _disk_entries(self):
+        # (路径, 大小, 最近访问时间)
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # 用修改时间记录最近一次访问, 淘汰时先删最久没用到的
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _disk_put(self, key, data):
+        if len(data) > self.disk_bytes:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名, 多个进程同时写同一个键也不会读到半个文件
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        existed = os.path.exists(path)
+        os.replace(tmp, path)
+        with self._lock:
+            if not existed:
+                self._disk_used += len(data)
+                self._disk_written += len(data)
+            # _disk_used 只包含本进程的写入, 其他进程(例如批量转换的各个工作进程)写入的看不到,
+            # 写入一定量之后重新统计一次目录
+            if self._disk_written > self.disk_bytes * DISK_RESCAN_FRACTION:
+                self._disk_used = sum(size for _, size, _ in self._disk_entries())
+                self._disk_written = 0
+            if self._disk_used > self.disk_bytes:
+                self._disk_evict()
+
+    def _disk_evict(self):
+        # 重新统计磁盘占用(其他进程可能也在写), 删到上限的 90% 以下
+        entries = sorted(self._disk_entries(), key=lambda e: e[2])
+        self._disk_used = sum(size for _, size, _ in entries)
+        self._disk_written = 0
+        target = self.disk_bytes * 0.9
+        for path, size, _ in entries:
+            if self._disk_used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._disk_used -= size
+            self.stats["evictions"] += 1
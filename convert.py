@@ -0,0 +1,112 @@
+"""
+单张图片转换, 不加载界面
+
+脚本里每次只转换一两张图片时, 用这个入口启动最快: 不导入 Qt, 不启动进程池,
+opencv 只在用到 opencv 的灰度化方式时才导入(见 processing.py)
+
+用法示例:
+    python -m convert photo.jpg -o photo.png
+    python -m convert photo.jpg -o photo.cgb -p "pixelate, keep ratio, cv2 4-level, floyd"
+    python -m convert a.jpg b.jpg -o out/ -f cgb --timing
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+import processing
+import loader
+import bitplane
+from cache import ResultCache, make_key
+
+FORMATS = ("png", "bmp", "jpg", "cgb")
+
+
+def decode_rgb(data: bytes, pipeline: processing.Pipeline):
+    # 按屏幕规格缩小解码, 缩小后仍不小于屏幕大小
+    size = processing.screen_size(pipeline.profile)
+    return processing.to_rgb_array(loader.load_image(data, size, rotatable=False).image)
+
+
+def decode_levels(data: bytes, pipeline: processing.Pipeline):
+    # 源文件字节 -> 色阶索引
+    rgb = decode_rgb(data, pipeline)
+    return processing.quantize(processing.pixelate(rgb, pipeline.keep_ratio, pipeline.profile),
+                               pipeline.method, pipeline.dither)
+
+
+def encode_image(data: bytes, pipeline: processing.Pipeline, fmt: str = "png") -> bytes:
+    # 源文件字节 -> 输出文件字节
+    if fmt == "cgb":
+        return bitplane.encode(decode_levels(data, pipeline))
+    rgb = decode_rgb(data, pipeline)
+    buffer = io.BytesIO()
+    Image.fromarray(processing.process(rgb, *pipeline)).save(buffer, format="JPEG" if fmt == "jpg" else fmt.upper())
+    return buffer.getvalue()
+
+
+def output_format(path, fmt=None):
+    # 没有指定格式时按输出文件的扩展名判断
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    ext = "jpg" if ext == "jpeg" else ext
+    return ext if ext in FORMATS else "png"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m convert", description="将图片转换为计算器屏幕格式(不加载界面)")
+    parser.add_argument("inputs", nargs="+", help="图片文件")
+    parser.add_argument("-o", "--output", required=True, help="输出文件; 有多个输入时为输出目录")
+    parser.add_argument("-p", "--pipeline", default="pixelate, keep ratio, 4-level",
+                        help='处理流程, 例如 "pixelate, keep ratio, cv2 4-level, red/green, 128x64"')
+    parser.add_argument("-f", "--format", choices=FORMATS, default=None, help="输出格式, 默认按输出文件的扩展名判断")
+    parser.add_argument("--cache-dir", default=None, help="结果缓存目录, 相同图片和参数再次转换时直接复用")
+    parser.add_argument("--timing", action="store_true", help="显示每张图片的耗时")
+    args = parser.parse_args(argv)
+
+    try:
+        pipeline = processing.parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+
+    cache = ResultCache(disk_dir=args.cache_dir) if args.cache_dir else None
+
+    single = len(args.inputs) == 1 and not os.path.isdir(args.output)
+    failed = 0
+    for source in args.inputs:
+        start = time.perf_counter()
+        if single:
+            destination = args.output
+        else:
+            fmt = args.format or "png"
+            destination = os.path.join(args.output, os.path.splitext(os.path.basename(source))[0] + "." + fmt)
+        fmt = output_format(destination, args.format)
+        try:
+            with open(source, "rb") as f:
+                data = f.read()
+            encoded = None
+            if cache is not None:
+                key = make_key(data, pipeline, fmt)
+                encoded = cache.get(key)
+            if encoded is None:
+                encoded = encode_image(data, pipeline, fmt)
+                if cache is not None:
+                    cache.put(key, encoded)
+            os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+            with open(destination, "wb") as f:
+                f.write(encoded)
+        except Exception as e:
+            failed += 1
+            print(f"[fail] {source}: {type(e).__name__}: {e}", file=sys.stderr)
+            continue
+        if args.timing:
+            print(f"{source} -> {destination} ({(time.perf_counter() - start) * 1000:.1f} ms)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+按内存预算管理的撤销历史
+
+每一步不再保存完整的 PIL 图片:
+- 只含四级(二级)灰度颜色的图片按 2 位/像素打包保存(192x63 只要 3 KB)
+- 其他图片先原样保存, 超出内存预算时从最旧的开始换成"配方",
+  即原图加上一串操作, 跳转时从原图重新计算
+"""
+from PIL import Image
+
+import processing
+
+
+def apply_ops(source, ops):
+    # 从原图开始依次重放操作, 得到与当时完全相同的图片
+    img = source
+    for op in ops:
+        name = op[0]
+        if name == "rotate":
+            img = img.rotate(-90, expand=True)
+            continue
+        rgb = processing.to_rgb_array(img)
+        if name == "pixelate":
+            rgb = processing.pixelate(rgb, op[1])
+        elif name == "quantize":
+            rgb = processing.render(processing.quantize(rgb, *op[1:]))
+        elif name == "red_green":
+            rgb = processing.red_green(rgb)
+        else:
+            raise ValueError(f"未知操作: {name}")
+        img = Image.fromarray(rgb)
+    return img
+
+
+class _Levels:
+    # 打包后的四级灰度图片
+    def __init__(self, levels, red_green, pixel_grid):
+        self.height, self.width = levels.shape
+        self.packed = processing.pack_levels(levels)
+        self.red_green = red_green
+        self.pixel_grid = pixel_grid
+        self.nbytes = len(self.packed)
+
+    def restore(self):
+        levels = processing.unpack_levels(self.packed, self.width, self.height)
+        rgb = processing.render(levels, self.red_green)
+        if self.pixel_grid:
+            rgb = processing.grid(rgb)
+        return Image.fromarray(rgb)
+
+
+class _Raw:
+    # 原样保存的图片(图片对象不会被原地修改, 直接引用即可)
+    def __init__(self, image):
+        self.image = image
+        self.nbytes = image.width * image.height * len(image.getbands())
+
+    def restore(self):
+        return self.image
+
+
+class _Recipe:
+    # 原图 + 操作序列, 不占额外内存
+    nbytes = 0
+
+    def __init__(self, source, ops):
+        self.source = source
+        self.ops = tuple(ops)
+
+    def restore(self):
+        return apply_ops(self.source, self.ops)
+
+
+def compact(image, source, ops):
+    # 选择最省内存且能精确还原的保存方式
+    if image is None:
+        return None
+    if image is source and not ops:
+        return _Recipe(source, ops)
+    if image.width > processing.SCREEN_WIDTH or image.height > processing.SCREEN_HEIGHT:
+        # 比屏幕大的图片不会只有四种灰度, 不必在界面线程上逐像素检查
+        return _Raw(image)
+    found = processing.image_levels(processing.to_rgb_array(image))
+    if found is not None:
+        return _Levels(*found)
+    return _Raw(image)
+
+
+class UndoHistory:
+    def __init__(self, max_steps=15, budget_bytes=32 * 1024 * 1024):
+        # max_steps: 最多记录的步数; budget_bytes: 历史记录额外占用的内存上限
+        self.max_steps = max_steps
+        self.budget_bytes = budget_bytes
+        self.entries = []
+        # 上一次保存的像素化图片, 连续多步共用同一个像素化结果时只保存一份
+        self._last_pixelated = (None, None)
+        self._last_current = (None, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def labels(self):
+        return [entry["label"] for entry in self.entries]
+
+    def record(self, label, current, current_ops, pixelated, pixelated_ops, source, state):
+        # current/pixelated: 当前图片和像素化图片; *_ops: 它们从 source 得到的操作序列
+        # state: 其余需要恢复的界面状态
+        if pixelated is self._last_pixelated[0]:
+            pixelated_payload = self._last_pixelated[1]
+        else:
+            pixelated_payload = compact(pixelated, source, pixelated_ops)
+            self._last_pixelated = (pixelated, pixelated_payload)
+        # 只改变界面状态的步骤(例如切换像素边框)沿用上一步的图片
+        if self.entries and current is self._last_current[0]:
+            current_payload = self._last_current[1]
+        else:
+            current_payload = compact(current, source, current_ops)
+            self._last_current = (current, current_payload)
+        self.entries.append({
+            "label": label,
+            "source": source,
+            "current": current_payload,
+            "current_ops": tuple(current_ops),
+            "pixelated": pixelated_payload,
+            "pixelated_ops": tuple(pixelated_ops),
+            "state": dict(state),
+        })
+        self._trim()
+
+    def restore(self, index):
+        # 返回 (当前图片, 像素化图片, 界面状态)
+        entry = self.entries[index]
+        pixelated = entry["pixelated"].restore() if entry["pixelated"] else None
+        return entry["current"].restore(), pixelated, dict(entry["state"])
+
+    def truncate(self, length):
+        # 删除 length 之后的记录
+        del self.entries[length:]
+
+    def clear(self):
+        self.entries = []
+        self._last_pixelated = (None, None)
+        self._last_current = (None, None)
+
+    def nbytes(self):
+        # 历史记录额外占用的内存(不含当前正在使用的原图)
+        payloads = {}
+        sources = {}
+        for entry in self.entries:
+            for key in ("current", "pixelated"):
+                if entry[key] is not None:
+                    payloads[id(entry[key])] = entry[key].nbytes
+            sources[id(entry["source"])] = entry["source"]
+        current_source = self.entries[-1]["source"] if self.entries else None
+        source_bytes = sum(s.width * s.height * len(s.getbands())
+                           for s in sources.values() if s is not current_source and s is not None)
+        return sum(payloads.values()) + source_bytes
+
+    def _replace_payload(self, old, new):
+        for entry in self.entries:
+            for key in ("current", "pixelated"):
+                if entry[key] is old:
+                    entry[key] = new
+        if self._last_pixelated[1] is old:
+            self._last_pixelated = (self._last_pixelated[0], new)
+        if self._last_current[1] is old:
+            self._last_current = (self._last_current[0], new)
+
+    def _trim(self):
+        # 超出步数时删除第 2 项起最旧的记录, 保留"打开文件"
+        while len(self.entries) > self.max_steps:
+            del self.entries[1]
+        # 超出预算时先把最旧的原样保存的图片换成配方, 共用的图片要一起替换
+        for entry in list(self.entries):
+            for key in ("current", "pixelated"):
+                if self.nbytes() <= self.budget_bytes:
+                    return
+                raw = entry[key]
+                if isinstance(raw, _Raw):
+                    recipe = _Recipe(entry["source"], entry[key + "_ops"])
+                    self._replace_payload(raw, recipe)
+        # 仍然超出时, 删除属于之前打开的图片的记录
+        while self.nbytes() > self.budget_bytes and self.entries[0]["source"] is not self.entries[-1]["source"]:
+            del self.entries[0]
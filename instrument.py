@@ -0,0 +1,202 @@
+"""
+按操作统计耗时和内存
+
+每个操作记录墙钟时间、CPU 时间(当前线程)和新增内存峰值, 可以:
+- 汇总为每种操作的次数、总耗时、平均耗时、最大耗时, 显示在界面上
+- 导出为 JSON, 或 Chrome trace 格式(用 chrome://tracing 或 Perfetto 打开), 附在性能问题的反馈里
+
+内存用 tracemalloc 统计, 只能统计到 Python 和 NumPy 的分配(Pillow 内部的图像缓冲区不在其中),
+开启后分配内存会变慢, 所以默认只统计时间, 需要时用 trace_memory=True 开启
+多个线程同时统计内存时, 峰值是整个进程的, 只能作为参考
+
+用法:
+    profiler = Profiler(trace_memory=True)
+    with profiler.measure("pixelate"):
+        ...
+    with profiler.collect() as spans:  # 收集当前线程在这段代码中的记录
+        ...
+    profiler.dump_chrome_trace("trace.json")
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import NamedTuple, Optional
+
+
+class Span(NamedTuple):
+    name: str
+    start: float  # 相对于 Profiler 创建时刻的秒数
+    wall: float  # 墙钟时间(秒)
+    cpu: float  # 当前线程的 CPU 时间(秒)
+    alloc_bytes: Optional[int]  # 执行期间新增的内存峰值, 没有统计内存时为 None
+    thread: int
+    depth: int  # 嵌套层数, 0 为最外层
+
+
+class _Frame:
+    # 正在进行的一次测量
+    __slots__ = ("start_bytes", "peak")
+
+    def __init__(self, start_bytes):
+        self.start_bytes = start_bytes
+        self.peak = start_bytes
+
+
+class Profiler:
+    def __init__(self, trace_memory=False, max_spans=10000):
+        # trace_memory: 是否用 tracemalloc 统计内存; max_spans: 最多保留的记录数, 超出时丢弃最旧的
+        self.spans = deque(maxlen=max_spans)
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracing = False
+        self.set_trace_memory(trace_memory)
+
+    def set_trace_memory(self, enabled):
+        # 开关内存统计, 只停止由自己启动的 tracemalloc
+        self.trace_memory = enabled
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        elif not enabled and self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.collectors = []
+        return self._local.stack
+
+    @contextmanager
+    def measure(self, name):
+        stack = self._stack()
+        frame = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # reset_peak 是全局的, 先把到目前为止的峰值记到外层的测量上(外层开始时没有统计内存则跳过)
+            if stack and stack[-1] is not None:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            frame = _Frame(current)
+        stack.append(frame)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - cpu_start
+            stack.pop()
+            alloc = None
+            if frame is not None and tracemalloc.is_tracing():
+                frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+                alloc = frame.peak - frame.start_bytes
+                if stack and stack[-1] is not None:
+                    stack[-1].peak = max(stack[-1].peak, frame.peak)
+            span = Span(name, start - self._epoch, wall, cpu, alloc, threading.get_ident(), len(stack))
+            with self._lock:
+                self.spans.append(span)
+            for spans in self._local.collectors:
+                spans.append(span)
+
+    def timed(self, name=None):
+        # 装饰器版本的 measure, name 默认为函数名
+        def decorator(func):
+            label = name or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.measure(label):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def collect(self):
+        # 收集当前线程在这段代码中产生的记录, 例如一次请求中的各个步骤
+        self._stack()
+        spans = []
+        self._local.collectors.append(spans)
+        try:
+            yield spans
+        finally:
+            self._local.collectors.remove(spans)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+    def summary(self):
+        # 按操作名汇总, 返回 {名称: {count, wall_ms, mean_ms, max_ms, cpu_ms, alloc_kb}}, 按总耗时从大到小排列
+        with self._lock:
+            spans = list(self.spans)
+        result = {}
+        for span in spans:
+            row = result.setdefault(span.name, {"count": 0, "wall_ms": 0.0, "max_ms": 0.0, "cpu_ms": 0.0,
+                                                "alloc_kb": None})
+            row["count"] += 1
+            row["wall_ms"] += span.wall * 1000
+            row["max_ms"] = max(row["max_ms"], span.wall * 1000)
+            row["cpu_ms"] += span.cpu * 1000
+            if span.alloc_bytes is not None:
+                row["alloc_kb"] = max(row["alloc_kb"] or 0, span.alloc_bytes / 1024)
+        for row in result.values():
+            row["mean_ms"] = row["wall_ms"] / row["count"]
+        return dict(sorted(result.items(), key=lambda item: -item[1]["wall_ms"]))
+
+    def format_summary(self, limit=8):
+        # 用于界面显示的多行文本: 最近一次操作, 以及总耗时最多的几种操作
+        with self._lock:
+            last = self.spans[-1] if self.spans else None
+        if last is None:
+            return "暂无性能记录"
+        lines = [f"最近: {last.name} {format_span(last)}", "操作 次数 平均/最大 ms CPU ms 峰值 KB"]
+        for name, row in list(self.summary().items())[:limit]:
+            alloc = "-" if row["alloc_kb"] is None else f"{row['alloc_kb']:.0f}"
+            lines.append(f"{name} {row['count']} {row['mean_ms']:.1f}/{row['max_ms']:.1f} "
+                         f"{row['cpu_ms'] / row['count']:.1f} {alloc}")
+        return "\n".join(lines)
+
+    def to_json(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {"spans": [span._asdict() for span in spans], "summary": self.summary()}
+
+    def to_chrome_trace(self):
+        # Chrome trace 事件格式, 每条记录为一个完整事件(ph=X), 时间单位为微秒
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for span in spans:
+            args = {"cpu_ms": round(span.cpu * 1000, 3)}
+            if span.alloc_bytes is not None:
+                args["alloc_bytes"] = span.alloc_bytes
+            events.append({"name": span.name, "ph": "X", "ts": round(span.start * 1e6, 1),
+                           "dur": round(span.wall * 1e6, 1), "pid": pid, "tid": span.thread, "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        # 文件名以 .trace.json 结尾时写出 Chrome trace, 否则写出 JSON
+        data = self.to_chrome_trace() if path.lower().endswith(".trace.json") else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+
+
+def format_span(span: Span) -> str:
+    text = f"{span.wall * 1000:.1f} ms (CPU {span.cpu * 1000:.1f} ms"
+    if span.alloc_bytes is not None:
+        text += f", 峰值 {span.alloc_bytes / 1024:.0f} KB"
+    return text + ")"
+
+
+def server_timing(spans) -> str:
+    # Server-Timing 响应头, 浏览器开发者工具的网络面板中可以直接看到各步骤耗时
+    return ", ".join(f'{span.name};dur={span.wall * 1000:.2f};desc="cpu {span.cpu * 1000:.2f}ms"'
+                     for span in spans)
@@ -0,0 +1,101 @@
+"""
+按目标大小缩小解码
+
+第一步处理总是把图片缩到 63 行高或 192x63, 完整解码一张手机照片却要几十上百 MB 内存和好几秒,
+这里根据目标大小选择一个缩小倍数(1/2, 1/4, 1/8), 保证缩小后的图片仍然不小于目标大小,
+这样之后的最近邻缩放每个输出像素都有对应的源像素:
+- JPEG 使用 draft 模式, 解码时直接按 DCT 缩放, 峰值内存和解码时间都按倍数平方减少
+- OpenCV 后端使用 IMREAD_REDUCED_COLOR_*
+- 其他格式只能完整解码, 之后用 Image.reduce 缩小, 减少之后一直占用的内存
+"""
+import io
+import time
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+import processing
+
+SCALES = (8, 4, 2, 1)
+
+
+class LoadResult(NamedTuple):
+    image: Image.Image
+    scale: int  # 缩小倍数, 1 为完整解码
+    seconds: float  # 解码用时
+    peak_bytes: int  # 解码过程中图像缓冲区的峰值大小
+    held_bytes: int  # 返回的图片占用的大小
+    full_bytes: int  # 完整解码需要的图像缓冲区大小
+
+
+def choose_scale(width, height, size=(processing.SCREEN_WIDTH, processing.SCREEN_HEIGHT), rotatable=True):
+    # 选择最大的缩小倍数, 缩小后仍然不小于目标大小
+    # rotatable 为 True 时图片之后可能被旋转, 宽高都要不小于目标的较大边
+    if rotatable:
+        need_width = need_height = max(size)
+    else:
+        need_width, need_height = size
+    for scale in SCALES:
+        if width // scale >= need_width and height // scale >= need_height:
+            return scale
+    return 1
+
+
+def _image_bytes(width, height, mode):
+    return width * height * Image.getmodebands(mode)
+
+
+def load_image(fp, size=(processing.SCREEN_WIDTH, processing.SCREEN_HEIGHT), rotatable=True, backend="pil"):
+    # fp 可以是文件路径、文件对象或 bytes
+    start = time.perf_counter()
+    if isinstance(fp, (bytes, bytearray)):
+        fp = io.BytesIO(fp)
+    img = Image.open(fp)
+    width, height = img.size
+    full_bytes = _image_bytes(width, height, "RGB" if img.mode in ("P", "1") else img.mode)
+    scale = choose_scale(width, height, size, rotatable)
+
+    # opencv 只对 JPEG 能真正缩小解码, 其他格式仍然走 Pillow
+    if backend == "cv2" and img.format == "JPEG":
+        img = _load_cv2(fp, scale)
+        peak_bytes = None
+    elif img.format == "JPEG" and scale > 1:
+        img.draft("RGB", (width // scale, height // scale))
+        img.load()
+        peak_bytes = None
+    else:
+        img.load()
+        peak_bytes = _image_bytes(img.width, img.height, img.mode)
+        if scale > 1 and img.mode in ("L", "LA", "RGB", "RGBA"):
+            img = img.reduce(scale)
+    scale = round(width / img.width)
+    seconds = time.perf_counter() - start
+    held_bytes = _image_bytes(img.width, img.height, img.mode)
+    return LoadResult(img, scale, seconds, peak_bytes or held_bytes, held_bytes, full_bytes)
+
+
+def _load_cv2(fp, scale):
+    # 只有使用 opencv 后端时才导入 opencv
+    import cv2
+    flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+             4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    if isinstance(fp, str):
+        # 用 fromfile + imdecode, 避免 imread 不支持中文路径
+        data = np.fromfile(fp, dtype=np.uint8)
+    else:
+        fp.seek(0)
+        data = np.frombuffer(fp.read(), dtype=np.uint8)
+    bgr = cv2.imdecode(data, flags[scale])
+    if bgr is None:
+        raise OSError("opencv 无法解码图片")
+    return Image.fromarray(np.ascontiguousarray(bgr[..., ::-1]))
+
+
+def describe(result: LoadResult) -> str:
+    # 用于界面和命令行显示的一行说明
+    text = (f"解码 {result.seconds * 1000:.0f} ms, 峰值 {result.peak_bytes / 1048576:.1f} MB, "
+            f"占用 {result.held_bytes / 1048576:.1f} MB")
+    if result.scale > 1:
+        text += f" (缩小 1/{result.scale}, 完整解码需要 {result.full_bytes / 1048576:.1f} MB)"
+    return text
@@ -1,31 +1,61 @@
 import sys
-import cv2
-import numpy as np
-from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QPushButton, QFileDialog, QLabel, QMessageBox, QGridLayout, QCheckBox,QListWidget,QVBoxLayout
-
-from PyQt6.QtGui import QPixmap, QImage
-from PyQt6.QtCore import Qt
-from PIL import Image, ImageQt, ImageOps,ImageFile,ImageDraw
-import os, PyQt6
-dirname = os.path.dirname(PyQt6.__file__)
-qt_dir = os.path.join(dirname, 'Qt5', 'plugins', 'platforms')
-os.environ['QT_QPA_PLATFORM_PLUGIN_PATH'] = qt_dir
+from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QPushButton, QFileDialog, QLabel, QMessageBox, QGridLayout, QCheckBox,QListWidget,QVBoxLayout,QComboBox
+
+from PyQt6.QtGui import QPixmap, QImage, QPainter, QColor
+from PyQt6.QtCore import Qt, QLineF, QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+from PIL import Image, ImageQt, ImageFile
+import os
+import processing
+from history import UndoHistory, apply_ops
+from stages import StagePipeline
+from variants import make_variants, render_variants
+import bitplane
+import loader
+import instrument
+# 各操作的耗时和内存记录, 显示在撤销列表下方, 也可以导出
+# 统计内存会让处理变慢好几倍, 默认只统计时间, 在界面上勾选后开启
+profiler = instrument.Profiler()
+
+@profiler.timed()
 def pixel_line(img:ImageFile.ImageFile):
-    # 读取图片宽高并乘以3
-    w = img.width * 6
-    h = img.height * 6
-    # 调整图片大小
-    img_resize = img.resize((w,h),Image.NEAREST)
-    # 初始化画笔
-    draw = ImageDraw.Draw(img_resize)
-    # 画竖线
-    for i in range(w):
-        draw.line([(6*i,0),(6*i,h)],fill=(0,0,255))
-    # 画横线
-    for j in range(h):
-        draw.line([(0,6*j),(w,6*j)],fill=(0,0,255))
-    # 返回图片
-    return img_resize
+    # 放大6倍并画上像素分割线
+    return Image.fromarray(processing.grid(processing.to_rgb_array(img)))
+
+def rotate(img):
+    # 顺时针旋转 90 度
+    return img.rotate(-90, expand=True)
+
+def red_green_image(img):
+    return Image.fromarray(processing.red_green(processing.to_rgb_array(img)))
+
+class WorkerSignals(QObject):
+    # QRunnable 不能发信号, 由这个对象把结果传回主线程
+    finished = pyqtSignal(object, object)
+    failed = pyqtSignal(str)
+
+class Worker(QRunnable):
+    # 在线程池中执行耗时的图片处理
+    def __init__(self, name, func, *args):
+        super().__init__()
+        self.name = name
+        self.func = func
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            with profiler.measure(self.name):
+                result = self.func(*self.args)
+            # 顺便在后台把预览要用的 QImage 转换好
+            image = result if isinstance(result, Image.Image) else getattr(result, "image", None)
+            prepared = None
+            if isinstance(image, Image.Image):
+                with profiler.measure("prepare_preview"):
+                    prepared = (image, ImageQt.ImageQt(image))
+        except Exception as e:
+            self.signals.failed.emit(f"{type(e).__name__}: {e}")
+            return
+        self.signals.finished.emit(result, prepared)
 
 class ImageProcessorApp(QMainWindow):
     def __init__(self):
@@ -34,27 +64,26 @@ class ImageProcessorApp(QMainWindow):
         self.setGeometry(100, 100, 800, 600)
 
         # -------------/ 撤销相关变量 /-------------
-        # 撤销列表的相关变量
-        self.undo_list_vars = []
+        # 撤销历史, 灰度化后的图片按 2 位/像素保存, 大图超出内存预算后改为从原图重新计算
+        self.history = UndoHistory(max_steps=15, budget_bytes=32 * 1024 * 1024)
 
         """
-        undo_list_vars存储的信息格式为:
-        {"pixel_image":self.pixelated_image, # 像素化后的图片
-        "pixeled":self.pixeled, # 是否有像素边框
+        每一步记录的界面状态格式为:
+        {"pixeled":self.pixeled, # 是否有像素边框
         "maintain_ratio":self.maintain_aspect_ratio_checkbox.isChecked(), # 是否维持原比例
         "pixel_type":self.last_pixel_type, # 上一次灰度化的类型
-        "red_green_mode":False # 红绿模式} 
+        "dither":"none", # 抖动方式
+        "red_green_mode":False # 红绿模式}
         """
 
         # 是否开启撤销
         self.undo_mode = True
-        # 跳转列表中每一项对应的图片文件
-        self.undo_images = [] # 存储的是current_image
-        # 是否开启撤销
-        self.undo_mode = True
+        # 当前图片和像素化图片分别由原图经过哪些操作得到, 用于在历史中按需重新计算
+        self.current_ops = ()
+        self.pixelated_ops = ()
         # -------------/ 撤销相关变量结束 /-------------
 
-        # 是否有像素边框
+        # 是否有像素边框(只在预览时绘制, 导出时才生成放大的图片)
         self.pixeled = False
         # 红绿模式前的四级像素模式
         self.last_pixel_type = ""
@@ -88,6 +117,11 @@ class ImageProcessorApp(QMainWindow):
         # 将列表添加到布局
         self.undo_layout.addWidget(self.undo_tip)
         self.undo_layout.addWidget(self.undo_list)
+        # 性能记录: 最近一次操作和各操作的耗时汇总
+        self.profile_label = QLabel(profiler.format_summary())
+        self.profile_label.setStyleSheet("QLabel { font-family: monospace; font-size: 11px; }")
+        self.profile_label.setWordWrap(True)
+        self.undo_layout.addWidget(self.profile_label)
 
 
         # 初始化按钮
@@ -101,6 +135,24 @@ class ImageProcessorApp(QMainWindow):
         # 红绿模式状态
         self.red_green_mode = False
 
+        # 像素化 -> 灰度化 -> 上色 的分阶段缓存, 原图为像素化之前的图片
+        # 切换红绿模式、灰度化方式或维持原比例时只重新计算改变的阶段
+        self.stages = StagePipeline()
+
+        # 后台处理线程池, 同一时间只处理一个操作
+        self.thread_pool = QThreadPool.globalInstance()
+        self.busy = False
+        self.worker = None
+        # 预览缓存: 对应的图片、转换好的 QPixmap, 以及后台线程提前转换好的 (图片, QImage)
+        self.preview_source = None
+        self.preview_pixmap = None
+        self.prepared_qimage = None
+        # 窗口大小改变时延迟缩放预览
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(50)
+        self.resize_timer.timeout.connect(self.rescale_preview)
+
     def init_buttons(self):
         # 选择图片按钮
         self.select_button = QPushButton("选择图片")
@@ -123,7 +175,16 @@ class ImageProcessorApp(QMainWindow):
         # 维持原比例复选框
         self.maintain_aspect_ratio_checkbox = QCheckBox("维持原比例")
         self.maintain_aspect_ratio_checkbox.setChecked(True)  # 默认勾选
-        self.control_layout.addWidget(self.maintain_aspect_ratio_checkbox, 2, 0, 1, 2)  # 跨两列
+        # 只响应用户点击, 撤销时恢复勾选状态不会触发重新像素化
+        self.maintain_aspect_ratio_checkbox.clicked.connect(self.change_keep_ratio)
+        self.control_layout.addWidget(self.maintain_aspect_ratio_checkbox, 2, 0)
+
+        # 抖动方式, 作用于下面三种灰度化
+        self.dither_combo = QComboBox()
+        for text, dither in (("不抖动", "none"), ("Floyd-Steinberg 抖动", "floyd"),
+                             ("Atkinson 抖动", "atkinson"), ("Bayer 有序抖动", "bayer")):
+            self.dither_combo.addItem(text, dither)
+        self.control_layout.addWidget(self.dither_combo, 2, 1)
 
         # 四级灰度化按钮
         self.grayscale_button = QPushButton("四级灰度化")
@@ -150,7 +211,7 @@ class ImageProcessorApp(QMainWindow):
         self.control_layout.addWidget(self.red_green_button, 5,0, 1,2)
 
         # 像素边框按钮
-        self.pixel_border_button = QPushButton("像素边框(请最后再用)")
+        self.pixel_border_button = QPushButton("像素边框")
         self.pixel_border_button.clicked.connect(self.pixel_border)
         self.pixel_border_button.setStyleSheet("QPushButton { padding: 10px; font-size: 14px; }")
         self.control_layout.addWidget(self.pixel_border_button, 7, 0, 1, 2) # 跨两列
@@ -159,7 +220,13 @@ class ImageProcessorApp(QMainWindow):
         self.export_button = QPushButton("导出图片")
         self.export_button.clicked.connect(self.export_image)
         self.export_button.setStyleSheet("QPushButton { padding: 10px; font-size: 14px; }")
-        self.control_layout.addWidget(self.export_button, 8, 0, 1, 2)  # 跨两列
+        self.control_layout.addWidget(self.export_button, 8, 0)
+
+        # 导出全部版本按钮
+        self.export_variants_button = QPushButton("导出全部版本")
+        self.export_variants_button.clicked.connect(self.export_variants)
+        self.export_variants_button.setStyleSheet("QPushButton { padding: 10px; font-size: 14px; }")
+        self.control_layout.addWidget(self.export_variants_button, 8, 1)
 
         # 版本号
         self.info_label = QLabel("版本号: v1.5\n本产品为完全免费的开源软件")
@@ -178,74 +245,190 @@ class ImageProcessorApp(QMainWindow):
         self.close_undo_button.clicked.connect(self.switch_undo_mode)
         self.undo_layout.addWidget(self.close_undo_button)
 
+        # 导出性能记录
+        self.export_profile_button = QPushButton("导出性能记录")
+        self.export_profile_button.setStyleSheet("QPushButton { padding: 10px; font-size: 14px; }")
+        self.export_profile_button.clicked.connect(self.export_profile)
+        self.undo_layout.addWidget(self.export_profile_button)
+
+        # 统计内存
+        self.trace_memory_checkbox = QCheckBox("统计内存(处理会变慢)")
+        self.trace_memory_checkbox.toggled.connect(profiler.set_trace_memory)
+        self.undo_layout.addWidget(self.trace_memory_checkbox)
+
+    def stage_pipeline(self, **changes):
+        # 当前像素化图片对应的参数, 维持原比例取像素化时的设置而不是复选框的当前状态
+        keep_ratio = self.pixelated_ops[-1][1] if self.pixelated_ops else True
+        return processing.Pipeline(keep_ratio=keep_ratio, method=self.last_pixel_type or "grayscale",
+                                   red_green_mode=self.red_green_mode,
+                                   dither=self.dither_combo.currentData())._replace(**changes)
+
+    def stage_image(self, pipeline, stage="render"):
+        # 从阶段缓存取结果, 会在后台线程中调用
+        return Image.fromarray(self.stages.run(pipeline, stage))
+
+    def stage_pixelate(self, image, keep_ratio):
+        # 以 image 为原图像素化, 会在后台线程中调用
+        self.stages.set_source(image)
+        return self.stage_image(processing.Pipeline(keep_ratio=keep_ratio), "pixelate")
+
+    def stage_tail(self):
+        # 当前图片就是像素化图片(或它直接灰度化、再开启红绿模式的结果)时, 返回像素化之后的操作, 否则返回 None
+        n = len(self.pixelated_ops)
+        tail = self.current_ops[n:]
+        if not self.pixelated_image or self.current_ops[:n] != self.pixelated_ops:
+            return None
+        if not tail or (tail[0][0] == "quantize" and tail[1:] in ((), (("red_green",),))):
+            return tail
+        return None
+
+    def tail_pipeline(self, tail, **changes):
+        # 像素化之后的操作 -> 对应的阶段参数
+        return self.stage_pipeline(method=tail[0][1], dither=tail[0][2],
+                                   red_green_mode=(("red_green",) in tail))._replace(**changes)
+
+    def change_keep_ratio(self):
+        # 已经像素化时切换维持原比例: 重新像素化, 之后的灰度化和红绿模式按原来的参数重新应用
+        # 像素化之后还旋转过等情况无法按阶段重算, 只影响下一次像素化
+        tail = self.stage_tail()
+        if tail is None or self.stages.source is None:
+            return
+        keep_ratio = self.maintain_aspect_ratio_checkbox.isChecked()
+        pixelated_ops = self.pixelated_ops[:-1] + (("pixelate", keep_ratio),)
+        pixelate_pipeline = processing.Pipeline(keep_ratio=keep_ratio)
+        pipeline = self.tail_pipeline(tail, keep_ratio=keep_ratio) if tail else None
+
+        def work():
+            pixelated = self.stage_image(pixelate_pipeline, "pixelate")
+            return pixelated, self.stage_image(pipeline) if pipeline else pixelated
+
+        def done(result):
+            self.pixelated_image, self.current_image = result
+            self.pixelated_ops = pixelated_ops
+            self.current_ops = pixelated_ops + tail
+            self.update_preview()
+            self.record_step("维持原比例" if keep_ratio else "取消维持原比例")
+
+        self.run_task("change_keep_ratio", work, on_done=done)
+
+    def restore_step(self, index):
+        # 恢复历史记录, 同时重放出像素化之前的图片作为阶段缓存的原图, 会在后台线程中调用
+        current, pixelated, state = self.history.restore(index)
+        entry = self.history.entries[index]
+        pixelate_input = None
+        if pixelated is not None:
+            pixelate_input = apply_ops(entry["source"], entry["pixelated_ops"][:-1])
+        return current, pixelated, state, pixelate_input
+
+    def run_task(self, name, func, *args, on_done):
+        # 在线程池中执行 func(*args), 完成后在主线程调用 on_done(结果), name 为性能记录中的操作名
+        # 处理期间禁用按钮, 避免在图片还没算完时进行下一步操作
+        if self.busy:
+            return
+        self.busy = True
+        self.control_frame.setEnabled(False)
+        self.undo_frame.setEnabled(False)
+        self.statusBar().showMessage("正在处理...")
+        worker = Worker(name, func, *args)
+        worker.signals.finished.connect(lambda result, prepared: self.task_done(on_done, result, prepared))
+        worker.signals.failed.connect(self.task_failed)
+        # 保持引用, 直到结果传回主线程
+        self.worker = worker
+        self.thread_pool.start(worker)
+
+    def task_finished(self):
+        self.busy = False
+        self.worker = None
+        self.control_frame.setEnabled(True)
+        self.undo_frame.setEnabled(True)
+        self.statusBar().clearMessage()
+
+    def task_done(self, on_done, result, prepared):
+        self.task_finished()
+        # 后台线程已经转换好的 (图片, QImage), update_preview 会直接使用
+        self.prepared_qimage = prepared
+        on_done(result)
+
+    def task_failed(self, message):
+        self.task_finished()
+        QMessageBox.warning(self, "错误", f"处理失败: {message}")
+
+    def record_step(self, name):
+        # 记录一步操作到撤销历史, 并在这一步的处理全部结束后刷新性能记录
+        QTimer.singleShot(0, self.refresh_profile)
+        if self.undo_mode:
+            self.history.record(name, self.current_image, self.current_ops,
+                                self.pixelated_image, self.pixelated_ops, self.image,
+                                {"pixeled": self.pixeled,
+                                 "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
+                                 "pixel_type": self.last_pixel_type, "red_green_mode": self.red_green_mode,
+                                 "dither": self.dither_combo.currentData()})
+            self.refresh_undo_list()
+
+    def refresh_undo_list(self):
+        # 历史记录可能因为步数或内存预算被删减, 以历史记录为准重建列表
+        self.undo_list.clear()
+        self.undo_list.addItems(self.history.labels())
+
     def undo_jump_to(self):
         if self.undo_mode:
             index = self.undo_list.currentRow()
-            # 设置图片和变量到跳转的位置
-            self.current_image = self.undo_images[index]
-            self.pixelated_image = self.undo_list_vars[index]["pixel_image"]
-            self.pixeled = self.undo_list_vars[index]["pixeled"]
-            self.maintain_aspect_ratio_checkbox.setChecked(self.undo_list_vars[index]["maintain_ratio"])
-            self.last_pixel_type = self.undo_list_vars[index]["pixel_type"]
-            if self.last_pixel_type:
-                self.red_green_mode = not self.undo_list_vars[index]["red_green_mode"]
-                self.toggle_red_green_mode()
-            # 删除多余的记录
-            for i in range(index+1, len(self.undo_images)):
-                self.undo_images.pop()
-                self.undo_list_vars.pop()
-                self.undo_list.takeItem(index+1)
-            # 设置跳转的位置变量
-            self.update_preview()
+            if index < 0:
+                return
+
+            def done(restored):
+                # 设置图片和变量到跳转的位置
+                self.current_image, self.pixelated_image, state, pixelate_input = restored
+                self.image = self.history.entries[index]["source"]
+                self.current_ops = self.history.entries[index]["current_ops"]
+                self.pixelated_ops = self.history.entries[index]["pixelated_ops"]
+                # 阶段缓存换成这一步的原图, 并直接放入恢复出的像素化图片
+                self.stages.set_source(pixelate_input)
+                if self.pixelated_image is not None:
+                    self.stages.seed("pixelate", self.stage_pipeline(),
+                                     processing.to_rgb_array(self.pixelated_image))
+                self.pixeled = state["pixeled"]
+                self.pixel_border_button.setText("取消像素边框" if self.pixeled else "像素边框")
+                self.maintain_aspect_ratio_checkbox.setChecked(state["maintain_ratio"])
+                self.last_pixel_type = state["pixel_type"]
+                self.dither_combo.setCurrentIndex(self.dither_combo.findData(state["dither"]))
+                # 记录中的图片已经是对应红绿模式的结果, 只需同步按钮文本
+                self.red_green_mode = state["red_green_mode"]
+                self.red_green_button.setText("普通模式" if self.red_green_mode else "红绿模式")
+                # 删除多余的记录
+                self.history.truncate(index + 1)
+                self.refresh_undo_list()
+                # 设置跳转的位置变量
+                self.update_preview()
+
+            # 超出内存预算的记录需要从原图重新计算, 放到后台线程
+            self.run_task("undo_jump_to", self.restore_step, index, on_done=done)
 
     def switch_undo_mode(self):
         self.undo_mode = not self.undo_mode
         if not self.undo_mode:
             self.close_undo_button.setText("开始记录操作")
             self.undo_list.clear()
-            self.undo_images = []
-            self.undo_list_vars = []
+            self.history.clear()
 
         else:
             self.close_undo_button.setText("不记录操作(节省内存)")
 
     def _4level_cv2(self):
         # 使用opencv将图片转为4级灰度(似乎效果比pillow更好,仅供测试)
-        # 将Pillow图像转换为OpenCV格式
         if self.pixelated_image:
+            dither = self.dither_combo.currentData()
             # 设置红绿模式的上一个模式标记
             self.last_pixel_type = "cv2"
-            image_np = np.array(self.pixelated_image.convert("RGB"))
-            gray_image = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
 
-            # 将灰度图像量化为四个级别
-            # 0-63 -> 0, 64-127 -> 85, 128-191 -> 170, 192-255 -> 255
-            four_level_image = np.clip((gray_image // 64) * 85, 0, 255).astype(np.uint8)
-
-            # 定义四个颜色级别
-            color_levels = {
-                0: (0, 0, 0),  # 最浅色 -> 白色
-                85: (149, 149, 149),  # 第二浅色 -> #959595
-                170: (186, 186, 186),  # 第三浅色 -> #BABABA
-                255: (255, 255, 255)  # 第四浅色 -> 黑色
-            }
-
-            # 创建一个新的RGB图像
-            rgb_image = np.zeros((gray_image.shape[0], gray_image.shape[1], 3), dtype=np.uint8)
-
-            # 替换颜色
-            for level, color in color_levels.items():
-                rgb_image[four_level_image == level] = color
-
-            # 将OpenCV图像转换回Pillow格式
-            four_level_pillow_image = Image.fromarray(rgb_image)
+            def done(image):
+                self.current_image = image
+                self.current_ops = self.pixelated_ops + (("quantize", "cv2", dither),)
+                self.update_preview()
+                self.record_step("opencv四级灰度化")
 
-            self.current_image = four_level_pillow_image
-            self.update_preview()
-            if self.undo_mode:
-                self.undo_list_vars.append({"pixel_image":self.pixelated_image,"pixeled":self.pixeled,"maintain_ratio":self.maintain_aspect_ratio_checkbox.isChecked(),"pixel_type":self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                self.undo_images.append(self.current_image)
-                self.undo_list.addItem("opencv四级灰度化")
+            self.run_task("_4level_cv2", self.stage_image, self.stage_pipeline(method="cv2", dither=dither, red_green_mode=False),
+                          on_done=done)
         else:
             QMessageBox.warning(self, "警告", "请先像素化图片")
 
@@ -253,202 +436,166 @@ class ImageProcessorApp(QMainWindow):
         # 打开文件选择对话框
         file_path, _ = QFileDialog.getOpenFileName(self, "选择图片", "", "图片文件 (*.jpg *.jpeg *.png *.bmp *.gif *.webp)")
         if file_path:
-            # 加载图像并显示在预览区
-            self.image = Image.open(file_path)
-            self.current_image = self.image
-            self.update_preview()
-            if self.undo_mode:
-                self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                            "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                            "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                self.undo_images.append(self.current_image)
-                self.undo_list.addItem("打开文件")
+            def done(result):
+                self.image = result.image
+                self.current_image = self.image
+                self.current_ops = ()
+                # 新图片需要重新像素化
+                self.pixelated_image = None
+                self.pixelated_ops = ()
+                self.stages.set_source(None)
+                self.pixeled = False
+                self.pixel_border_button.setText("像素边框")
+                self.update_preview()
+                self.statusBar().showMessage(loader.describe(result))
+                self.record_step("打开文件")
+
+            # 按像素化的目标大小缩小解码, 并显示在预览区
+            self.run_task("select_image", loader.load_image, file_path, on_done=done)
 
     def pixel_border(self):
         if self.current_image:
-            if not self.pixeled:
-                # 调用 pixel_line 函数,并存储到 current_image
-                self.current_image = pixel_line(self.current_image)
-                # 标记,以保证在导出图片时不进行resize
-                self.pixeled = True
-                # 更新预览
-                self.update_preview()
-                if self.undo_mode:
-                    self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                                "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                                "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                    self.undo_images.append(self.current_image)
-                    self.undo_list.addItem("像素分割线")
-            else:
-                QMessageBox.warning(self, "警告", "已经进行像素分割线,请勿再次使用\n如果你多次这么做,你的内存会当场爆炸(")
+            # 像素边框只是预览上的一层网格, 切换时不需要处理图片
+            self.pixeled = not self.pixeled
+            self.pixel_border_button.setText("取消像素边框" if self.pixeled else "像素边框")
+            self.rescale_preview()
+            self.record_step("像素分割线" if self.pixeled else "取消像素分割线")
         else:
             QMessageBox.warning(self, "警告", "请先选择图片")
 
+    def refresh_profile(self):
+        self.profile_label.setText(profiler.format_summary())
+
+    def export_profile(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "导出性能记录", "profile.json",
+                                                   "JSON (*.json);;Chrome trace (*.trace.json)")
+        if file_path:
+            # 以 .trace.json 结尾时导出为 Chrome trace, 可以用 chrome://tracing 或 Perfetto 打开
+            profiler.dump(file_path)
+            QMessageBox.information(self, "成功", "性能记录已导出")
+
+    @profiler.timed()
     def update_preview(self):
         if self.current_image:
-            # 将 PIL 图像转换为 QPixmap
-            qimage = ImageQt.ImageQt(self.current_image)
-            pixmap = QPixmap.fromImage(qimage)
-
+            # 同一张图片只转换一次 QPixmap, 之后只做缩放
+            if self.preview_source is not self.current_image:
+                if self.prepared_qimage and self.prepared_qimage[0] is self.current_image:
+                    qimage = self.prepared_qimage[1]
+                else:
+                    qimage = ImageQt.ImageQt(self.current_image)
+                self.preview_pixmap = QPixmap.fromImage(qimage)
+                self.preview_source = self.current_image
+            self.prepared_qimage = None
+            self.rescale_preview()
+
+    @profiler.timed()
+    def rescale_preview(self):
+        if self.preview_pixmap is not None:
             # 使用最近邻插值缩放图像
-            scaled_pixmap = pixmap.scaled(
+            scaled_pixmap = self.preview_pixmap.scaled(
                 self.preview_frame.size(),
                 Qt.AspectRatioMode.KeepAspectRatio,
                 Qt.TransformationMode.FastTransformation  # 使用最近邻插值
             )
+            if self.pixeled:
+                self.draw_pixel_grid(scaled_pixmap, self.preview_source.width, self.preview_source.height)
             self.preview_frame.setPixmap(scaled_pixmap)
-            # 检查undo_list
-            self.check_undo_list()
 
-    def check_undo_list(self):
-        # 检查undo_list是否超过15项,超过则删除第2项到最后一个
-        while self.undo_list.count() > 15:
-            self.undo_list.takeItem(1)
-            # 删除文件列表的第二个到最后一个
-            self.undo_images.__delitem__(1)
+    def draw_pixel_grid(self, pixmap, width, height):
+        # 在缩放后的预览上画出每个像素的分割线, 与导出时的 pixel_line 一致(线在每个像素的左边和上边)
+        cell_w = pixmap.width() / width
+        cell_h = pixmap.height() / height
+        # 像素显示得太小时网格会盖住整张图, 不画
+        if cell_w < 3 or cell_h < 3:
+            return
+        lines = [QLineF(int(i * cell_w), 0, int(i * cell_w), pixmap.height()) for i in range(width)]
+        lines += [QLineF(0, int(j * cell_h), pixmap.width(), int(j * cell_h)) for j in range(height)]
+        painter = QPainter(pixmap)
+        painter.setPen(QColor(*processing.GRID_COLOR))
+        painter.drawLines(lines)
+        painter.end()
 
     def resizeEvent(self, event):
-        # 窗口大小改变时更新预览
-        self.update_preview()
+        # 窗口大小改变时延迟缩放预览, 拖动窗口边缘时只在停顿后缩放一次
+        self.resize_timer.start()
         super().resizeEvent(event)
 
     def rotate_image(self):
         if self.current_image:
-            # 顺时针旋转 90 度
-            self.current_image = self.current_image.rotate(-90, expand=True)
-            self.update_preview()
-            if self.undo_mode:
-                self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                            "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                            "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                self.undo_images.append(self.current_image)
-                self.undo_list.addItem("旋转图片")
+            def done(image):
+                self.current_image = image
+                self.current_ops = self.current_ops + (("rotate",),)
+                self.update_preview()
+                self.record_step("旋转图片")
+
+            self.run_task("rotate_image", rotate, self.current_image, on_done=done)
         else:
             QMessageBox.warning(self, "警告", "请先选择图片")
 
     def pixelate_image(self):
         if self.current_image:
-            if self.maintain_aspect_ratio_checkbox.isChecked():
-                # 保持原比例，计算新的宽度
-                original_width, original_height = self.current_image.size
-                aspect_ratio = original_width / original_height
-                new_height = 63
-                new_width = int(new_height * aspect_ratio)
-
-                # 缩放图像
-                resized_image = self.current_image.resize((new_width, new_height), Image.Resampling.NEAREST)
+            keep_ratio = self.maintain_aspect_ratio_checkbox.isChecked()
 
-                # 创建一个 192x63 的空白图像
-                self.pixelated_image = Image.new("RGB", (192, 63), (255, 255, 255))
-
-                # 将缩放后的图像居中放置在空白图像上
-                x_offset = (192 - new_width) // 2
-                self.pixelated_image.paste(resized_image, (x_offset, 0))
-
-            else:
-                # 不保持原比例，直接缩放为 192x63
-                self.pixelated_image = self.current_image.resize((192, 63), Image.Resampling.NEAREST)
+            def done(image):
+                self.pixelated_image = image
+                self.current_image = self.pixelated_image
+                self.current_ops = self.pixelated_ops = self.current_ops + (("pixelate", keep_ratio),)
+                self.update_preview()
+                self.record_step("像素化图片")
 
-            self.current_image = self.pixelated_image
-            self.update_preview()
-            if self.undo_mode:
-                self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                            "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                            "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                self.undo_images.append(self.current_image)
-                self.undo_list.addItem("像素化图片")
+            # 维持原比例时居中放在 192x63 的白色背景上, 否则直接缩放为 192x63
+            # 当前图片作为阶段缓存的原图, 之后切换维持原比例时从它重新像素化
+            self.run_task("pixelate_image", self.stage_pixelate, self.current_image, keep_ratio, on_done=done)
         else:
             QMessageBox.warning(self, "警告", "请先选择图片")
 
     def _2level_gray(self):
         if self.pixelated_image:
-            # 使用 OpenCV 进行二级灰度化处理
-            image_np = np.array(self.pixelated_image)
-            gray_image = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
+            dither = self.dither_combo.currentData()
 
-            # 使用自适应阈值增强辨识度
-            binary_image = cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+            def done(image):
+                self.current_image = image
+                self.current_ops = self.pixelated_ops + (("quantize", "2level", dither),)
+                # 更新图像
+                self.update_preview()
+                self.record_step("二级灰度化")
 
-            # 将二值图像转换回 PIL 图像
-            self.current_image = Image.fromarray(binary_image).convert("RGB")
-            # 更新图像
-            self.update_preview()
-            if self.undo_mode:
-                self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                            "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                            "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                self.undo_images.append(self.current_image)
-                self.undo_list.addItem("二级灰度化")
+            # 二级灰度化处理, 使用自适应阈值增强辨识度
+            self.run_task("_2level_gray", self.stage_image, self.stage_pipeline(method="2level", dither=dither, red_green_mode=False),
+                          on_done=done)
         else:
             QMessageBox.warning(self, "警告", "请先像素化图片")
 
     def grayscale_image(self):
         if self.pixelated_image:
+            dither = self.dither_combo.currentData()
             # 设置红绿模式的上一个模式标记
             self.last_pixel_type = "grayscale"
-            grayscale_image = ImageOps.grayscale(self.pixelated_image)
-
-            # 增强对比度，确保最浅色是白色
-            grayscale_image = ImageOps.autocontrast(grayscale_image)
-
-            # 将灰度图转换为四级灰度
-            quantized_image = grayscale_image.quantize(colors=4)
-
-            # 将四级灰度图像转换为 RGB 模式
-            quantized_image = quantized_image.convert("RGB")
-
-            # 获取四级灰度化后的四种颜色
-            colors = quantized_image.getcolors()
-            sorted_colors = sorted(colors, key=lambda x: sum(x[1]))  # 按颜色亮度排序
-
-            # 定义替换颜色
-            replace_colors = {
-                sorted_colors[0][1]: (0, 0, 0),  # 最浅色 -> 白色
-                sorted_colors[1][1]: (149, 149, 149),  # 第二浅色 -> #BABABA
-                sorted_colors[2][1]: (186, 186, 186),  # 第三浅色 -> #959595
-                sorted_colors[3][1]: (255, 255, 255),  # 第四浅色 -> 黑色
-            }
 
-            # 替换颜色
-            pixels = quantized_image.load()
-            for i in range(quantized_image.size[0]):
-                for j in range(quantized_image.size[1]):
-                    current_color = pixels[i, j]
-                    if current_color in replace_colors:
-                        pixels[i, j] = replace_colors[current_color]
-
-            # 显示处理后的图像
-            self.current_image = quantized_image
+            def done(image):
+                # 显示处理后的图像
+                self.current_image = image
+                self.current_ops = self.pixelated_ops + (("quantize", "grayscale", dither),)
+                self.update_preview()
+                self.record_step("标准四级灰度化")
 
-            self.update_preview()
-            if self.undo_mode:
-                self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                            "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                            "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                self.undo_images.append(self.current_image)
-                self.undo_list.addItem("标准四级灰度化")
+            # 灰度 -> 自动对比度 -> 四色量化, 再按亮度映射到四种颜色
+            self.run_task("grayscale_image", self.stage_image, self.stage_pipeline(method="grayscale", dither=dither, red_green_mode=False),
+                          on_done=done)
         else:
             QMessageBox.warning(self, "警告", "请先像素化图片")
 
     def apply_red_green_mode(self, image):
-        pixels = image.load()
-        for i in range(image.size[0]):
-            for j in range(image.size[1]):
-                r, g, b = pixels[i, j]
-                if (r, g, b) == (186, 186, 186):  # #BABABA -> 浅绿色
-                    pixels[i, j] = (144, 238, 144)  # 浅绿色
-                elif (r, g, b) == (149, 149, 149):  # #959595 -> 红色
-                    pixels[i, j] = (255, 0, 0)  # 红色
-                # 白色和黑色保持不变
-        self.current_image = image
-        self.update_preview()
-        if self.undo_mode:
-            self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                        "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                        "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-            self.undo_images.append(self.current_image)
-            self.undo_list.addItem("开启红绿模式")
+        def done(image):
+            self.current_image = image
+            self.current_ops = self.current_ops + (("red_green",),)
+            self.update_preview()
+            self.record_step("开启红绿模式")
+
+        # 查表替换: #BABABA -> 浅绿色, #959595 -> 红色, 白色和黑色保持不变
+        self.run_task("apply_red_green_mode", red_green_image, image, on_done=done)
 
+    @profiler.timed()
     def toggle_red_green_mode(self):
         if self.last_pixel_type:
             # 切换红绿模式状态
@@ -459,16 +606,18 @@ class ImageProcessorApp(QMainWindow):
                 self.red_green_button.setText("普通模式")
             else:
                 self.red_green_button.setText("红绿模式")
+            tail = self.stage_tail()
+            if tail:
+                # 当前图片就是灰度化的结果, 红绿模式只是换一套调色板, 色阶取自阶段缓存, 不需要重新灰度化
+                self.current_image = self.stage_image(self.tail_pipeline(tail, red_green_mode=self.red_green_mode))
+                self.current_ops = self.pixelated_ops + tail[:1] + ((("red_green",),) if self.red_green_mode else ())
+                self.update_preview()
+                self.record_step("开启红绿模式" if self.red_green_mode else "关闭红绿模式")
             # 如果红绿模式开启，应用红绿模式逻辑
-            if self.red_green_mode:
+            elif self.red_green_mode:
                 self.apply_red_green_mode(self.current_image)
             else:
-                if self.undo_mode:
-                    self.undo_list_vars.append({"pixel_image": self.pixelated_image, "pixeled": self.pixeled,
-                                                "maintain_ratio": self.maintain_aspect_ratio_checkbox.isChecked(),
-                                                "pixel_type": self.last_pixel_type,"red_green_mode":self.red_green_mode})
-                    self.undo_images.append(self.current_image)
-                    self.undo_list.addItem("关闭红绿模式")
+                self.record_step("关闭红绿模式")
                 if self.last_pixel_type == "cv2":
                     self._4level_cv2()
                 else:
@@ -479,29 +628,82 @@ class ImageProcessorApp(QMainWindow):
         else:
             QMessageBox.warning(self, "警告", "请先灰度化图片")
 
+    @profiler.timed("export_image")
+    def save_image(self, file_path):
+        # 按导出设置保存当前图片, 图片还不能保存为计算器位图时返回 False
+        # 计算器位图直接保存色阶的位平面
+        if file_path.lower().endswith(".cgb"):
+            found = processing.image_levels(processing.to_rgb_array(self.current_image))
+            if found is None:
+                return False
+            bitplane.save(file_path, found[0])
+        # 如果有像素边框,导出时才放大并画上分割线
+        elif self.pixeled:
+            pixel_line(self.current_image).save(file_path)
+        # 保存图像，保持原始大小
+        elif self.maintain_aspect_ratio_checkbox.isChecked():
+            # 如果维持原比例，导出时保持 192x63 大小
+
+            self.current_image.resize((192, 63), Image.Resampling.NEAREST).save(file_path)
+
+        else:
+            # 否则直接保存
+            self.current_image.save(file_path)
+        return True
+
     def export_image(self):
         if self.current_image:
             # 打开文件保存对话框
-            file_path, _ = QFileDialog.getSaveFileName(self, "保存图片", "", "图片文件 (*.png *.jpg *.bmp)")
+            file_path, _ = QFileDialog.getSaveFileName(self, "保存图片", "", "图片文件 (*.png *.jpg *.bmp);;计算器位图 (*.cgb)")
             if file_path:
-                # 如果有像素边框,则直接保存(不进行resize)
-                if self.pixeled:
-                    self.current_image.save(file_path)
-                # 保存图像，保持原始大小
-                elif self.maintain_aspect_ratio_checkbox.isChecked():
-                    # 如果维持原比例，导出时保持 192x63 大小
-
-                    self.current_image.resize((192, 63), Image.Resampling.NEAREST).save(file_path)
-
-                else:
-                    # 否则直接保存
-                    self.current_image.save(file_path)
+                if not self.save_image(file_path):
+                    QMessageBox.warning(self, "警告", "请先灰度化图片")
+                    return
+                self.refresh_profile()
                 QMessageBox.information(self, "成功", "图片已成功导出！")
         else:
             QMessageBox.warning(self, "警告", "没有图片可以导出")
 
+    def export_variants(self):
+        # 把像素化前的图片一次导出为四级、opencv四级、二级、红绿模式、像素分割线等版本
+        # 各版本共用同一个像素化和灰度化结果, 编码并行进行
+        source = self.stages.source if self.stages.source is not None else self.current_image
+        if source is None:
+            QMessageBox.warning(self, "警告", "没有图片可以导出")
+            return
+        out_dir = QFileDialog.getExistingDirectory(self, "选择导出目录")
+        if not out_dir:
+            return
+        dither = self.dither_combo.currentData()
+        variants = [variant._replace(pipeline=variant.pipeline._replace(dither=dither))
+                    for variant in make_variants(keep_ratio=self.maintain_aspect_ratio_checkbox.isChecked())]
+
+        def work():
+            outputs = render_variants(source, variants)
+            for label, data in outputs.items():
+                with open(os.path.join(out_dir, f"{label}.png"), "wb") as f:
+                    f.write(data)
+            return len(outputs)
+
+        def done(count):
+            self.refresh_profile()
+            QMessageBox.information(self, "成功", f"已导出 {count} 个版本")
+
+        self.run_task("export_variants", work, on_done=done)
+
+
+def set_qt_plugin_path():
+    # 打包后找不到 Qt 平台插件时指定插件目录, 只在启动界面时设置, 不覆盖已经设置的环境变量
+    import PyQt6
+    for qt in ("Qt6", "Qt5"):
+        qt_dir = os.path.join(os.path.dirname(PyQt6.__file__), qt, "plugins", "platforms")
+        if os.path.isdir(qt_dir):
+            os.environ.setdefault("QT_QPA_PLATFORM_PLUGIN_PATH", qt_dir)
+            return
+
 
 if __name__ == "__main__":
+    set_qt_plugin_path()
     app = QApplication(sys.argv)
     window = ImageProcessorApp()
     window.show()
@@ -0,0 +1,441 @@
+"""
+不依赖 Qt 的图片处理核心
+
+所有函数都以 NumPy 数组为输入输出:
+- RGB 图像为 (h, w, 3) 的 uint8 数组
+- 灰度结果以"色阶索引"表示, 为 (h, w) 的 uint8 数组, 取值 0~3
+  (0=黑, 1=#959595, 2=#BABABA, 3=白), 二级灰度只会出现 0 和 3
+色阶索引通过调色板查表一次性转换为 RGB, 不再逐像素替换颜色
+opencv 导入要 50 ms 以上, 只在用到它的函数中才导入, 只用 Pillow 的流程不需要加载
+"""
+import threading
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# 计算器屏幕分辨率
+SCREEN_WIDTH = 192
+SCREEN_HEIGHT = 63
+
+# 可选的屏幕规格: 名称 -> (宽, 高)
+SCREEN_PROFILES = {
+    "192x63": (SCREEN_WIDTH, SCREEN_HEIGHT),
+    "128x64": (128, 64),
+    "384x216": (384, 216),
+}
+DEFAULT_PROFILE = "192x63"
+
+# 四级灰度调色板, 下标即色阶索引
+GRAY_PALETTE = np.array([
+    (0, 0, 0),  # 黑色
+    (149, 149, 149),  # #959595
+    (186, 186, 186),  # #BABABA
+    (255, 255, 255),  # 白色
+], dtype=np.uint8)
+
+# 红绿模式调色板: #959595 -> 红色, #BABABA -> 浅绿色, 白色和黑色保持不变
+RED_GREEN_PALETTE = np.array([
+    (0, 0, 0),
+    (255, 0, 0),
+    (144, 238, 144),
+    (255, 255, 255),
+], dtype=np.uint8)
+
+# 像素分割线
+GRID_SCALE = 6
+GRID_COLOR = (0, 0, 255)
+
+# 任意 RGB 图像的红绿模式查找表, 只对 R=G=B 的灰色像素生效
+_RED_GREEN_LUT = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+_RED_GREEN_LUT[149] = RED_GREEN_PALETTE[1]
+_RED_GREEN_LUT[186] = RED_GREEN_PALETTE[2]
+
+
+def to_rgb_array(img: Image.Image) -> np.ndarray:
+    # PIL 图像 -> RGB 数组
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img)
+
+
+def to_gray(rgb: np.ndarray) -> np.ndarray:
+    # RGB -> 灰度, 与原来的 opencv 流程保持一致
+    import cv2
+    return cv2.cvtColor(np.ascontiguousarray(rgb), cv2.COLOR_RGB2GRAY)
+
+
+def nearest_index(src: int, dst: int) -> np.ndarray:
+    # 最近邻缩放时每个输出像素对应的源坐标
+    # Pillow 的 NEAREST 缩放是逐个累加浮点步长的, 这里用 cumsum 复现同样的舍入
+    scale = src / dst
+    steps = np.full(dst, scale)
+    steps[0] = scale * 0.5
+    return np.minimum(np.cumsum(steps).astype(np.intp), src - 1)
+
+
+def resize_nearest(rgb: np.ndarray, width: int, height: int) -> np.ndarray:
+    # 与 Image.resize(..., NEAREST) 结果一致的最近邻缩放
+    ys = nearest_index(rgb.shape[0], height)
+    xs = nearest_index(rgb.shape[1], width)
+    return rgb[ys[:, None], xs]
+
+
+def fit_width(width: int, height: int, screen_height: int = SCREEN_HEIGHT) -> int:
+    # 维持原比例时缩放后的宽度
+    return max(1, int(screen_height * (width / height)))
+
+
+def screen_size(profile) -> tuple:
+    # 屏幕规格名称或 (宽, 高) -> (宽, 高)
+    if isinstance(profile, str):
+        if profile not in SCREEN_PROFILES:
+            raise ValueError(f"未知的屏幕规格: {profile}")
+        return SCREEN_PROFILES[profile]
+    return tuple(profile)
+
+
+class ResamplePlan(NamedTuple):
+    # 某个源图大小缩放到某个屏幕大小时, 每个输出像素取自哪个源像素
+    size: tuple  # 屏幕 (宽, 高)
+    src_shape: tuple  # 源图 (高, 宽)
+    ys: np.ndarray  # (屏幕高, 1) 源图行号
+    xs: np.ndarray  # (1, span) 源图列号
+    flat: np.ndarray  # (屏幕高, span) 展平后的源像素下标, 源图连续存放时使用
+    dst_x: int  # 写入屏幕的起始列, 两侧为白色留边
+    span: int  # 写入的列数
+
+
+@lru_cache(maxsize=64)
+def resample_plan(src_width: int, src_height: int, size: tuple = (SCREEN_WIDTH, SCREEN_HEIGHT),
+                  keep_ratio: bool = True) -> ResamplePlan:
+    # 批量转换和视频中大量图片的源图大小相同, 缩放位置只需计算一次, 按 (源图大小, 屏幕大小, 维持原比例) 缓存
+    screen_width, screen_height = size
+    if not keep_ratio:
+        new_width, src_x, dst_x, span = screen_width, 0, 0, screen_width
+    else:
+        new_width = fit_width(src_width, src_height, screen_height)
+        x_offset = (screen_width - new_width) // 2
+        # 比屏幕宽时与 Image.paste 一样裁掉两侧
+        src_x = max(0, -x_offset)
+        dst_x = max(0, x_offset)
+        span = min(new_width - src_x, screen_width - dst_x)
+    ys = nearest_index(src_height, screen_height)[:, None]
+    xs = nearest_index(src_width, new_width)[None, src_x:src_x + span]
+    flat = ys * src_width + xs
+    # 计划在多次调用间共用, 不能修改; flat 不设为只读, 因为 np.take 遇到只读的下标数组会先复制一份
+    for array in (ys, xs):
+        array.setflags(write=False)
+    return ResamplePlan((screen_width, screen_height), (src_height, src_width), ys, xs, flat, dst_x, span)
+
+
+# 每个线程一块可重复使用的中间缓冲区, 见 apply_plan
+_scratch = threading.local()
+
+
+def _scratch_buffer(shape) -> np.ndarray:
+    # 大小变化时才重新分配, 连续处理同样大小的帧时不再分配内存
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.shape != shape:
+        buffer = _scratch.buffer = np.empty(shape, dtype=np.uint8)
+    return buffer
+
+
+def apply_plan(plan: ResamplePlan, rgb: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    # 按缩放计划取像素, out 为预先分配的 (屏幕高, 屏幕宽, 3) uint8 数组, 连续处理多帧时可重复使用
+    if rgb.shape[:2] != plan.src_shape:
+        raise ValueError(f"图片大小 {rgb.shape[1]}x{rgb.shape[0]} 与缩放计划不符")
+    screen_width, screen_height = plan.size
+    if out is None:
+        out = np.empty((screen_height, screen_width, 3), dtype=np.uint8)
+    out[:, :plan.dst_x] = 255
+    out[:, plan.dst_x + plan.span:] = 255
+    region = out[:, plan.dst_x:plan.dst_x + plan.span]
+    if rgb.flags.c_contiguous:
+        source, reverse = rgb, False
+    elif rgb[..., ::-1].flags.c_contiguous:
+        # opencv 读出的 BGR 帧翻转成的 RGB 视图: 从 BGR 原数组取像素, 写入时再调换通道, 不复制整张源图
+        source, reverse = rgb[..., ::-1], True
+    else:
+        region[...] = rgb[plan.ys, plan.xs]
+        return out
+    # take 的 mode="raise" 会先写入内部的临时数组, 下标都在范围内, 用 "clip" 直接写入
+    flat = source.reshape(-1, 3)
+    if region.flags.c_contiguous and not reverse:
+        # 没有留边时一次 take 直接写入输出
+        np.take(flat, plan.flat, axis=0, out=region, mode="clip")
+    else:
+        scratch = _scratch_buffer(plan.flat.shape + (3,))
+        np.take(flat, plan.flat, axis=0, out=scratch, mode="clip")
+        region[...] = scratch[..., ::-1] if reverse else scratch
+    return out
+
+
+def pixelate(rgb: np.ndarray, keep_ratio: bool = True,
+             size=(SCREEN_WIDTH, SCREEN_HEIGHT), out: np.ndarray = None) -> np.ndarray:
+    # 像素化为屏幕大小, 维持原比例时高度缩放到屏幕高度并水平居中放在白色背景上
+    # size 为 (宽, 高) 或 SCREEN_PROFILES 中的名称; 传入 out 时结果写入 out, 不再分配新数组
+    plan = resample_plan(rgb.shape[1], rgb.shape[0], screen_size(size), keep_ratio)
+    return apply_plan(plan, rgb, out)
+
+
+def autocontrast_gray(rgb: np.ndarray) -> Image.Image:
+    # 标准四级灰度化使用的灰度图: 灰度 -> 自动对比度
+    return ImageOps.autocontrast(ImageOps.grayscale(Image.fromarray(rgb)))
+
+
+def quantize_4level(rgb: np.ndarray) -> np.ndarray:
+    # 标准四级灰度化: 灰度 -> 自动对比度 -> 中值切分为 4 色, 再按亮度排序映射到色阶
+    quantized = autocontrast_gray(rgb).quantize(colors=4)
+    indices = np.asarray(quantized)
+    palette = np.array(quantized.getpalette()[:768], dtype=np.int32).reshape(-1, 3)
+
+    # 只给实际用到的调色板项排序, 亮度相同的颜色归为同一色阶
+    used = np.unique(indices)
+    brightness = palette[used].sum(axis=1)
+    distinct, rank = np.unique(brightness, return_inverse=True)
+    if len(distinct) > 1:
+        levels = np.rint(rank * 3 / (len(distinct) - 1)).astype(np.uint8)
+    else:
+        levels = np.full(len(used), 3 if distinct[0] > 0 else 0, dtype=np.uint8)
+
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[used] = levels
+    return lut[indices]
+
+
+def quantize_4level_cv2(rgb: np.ndarray) -> np.ndarray:
+    # opencv 风格四级灰度化: 0-63, 64-127, 128-191, 192-255 四段均分
+    return to_gray(rgb) >> 6
+
+
+def quantize_2level(rgb: np.ndarray) -> np.ndarray:
+    # 二级灰度化, 使用自适应阈值增强辨识度
+    import cv2
+    binary = cv2.adaptiveThreshold(to_gray(rgb), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    # 255 -> 3(白), 0 -> 0(黑)
+    return binary & 3
+
+
+# 灰度化方式, 名称与界面中 last_pixel_type 一致
+QUANTIZERS = {
+    "grayscale": quantize_4level,
+    "cv2": quantize_4level_cv2,
+    "2level": quantize_2level,
+}
+
+# 抖动时各色阶对应的灰度值
+LEVEL_VALUES = GRAY_PALETTE[:, 0].astype(np.float32)
+
+# 误差扩散核: (行偏移, 列偏移, 权重)
+_FLOYD_STEINBERG = ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16))
+# Atkinson 只扩散 3/4 的误差, 亮部和暗部更干净, 对比度更高
+_ATKINSON = ((0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8))
+DIFFUSION_KERNELS = {"floyd": _FLOYD_STEINBERG, "atkinson": _ATKINSON}
+
+# 抖动方式, "none" 为不抖动
+DITHERS = ("none", "floyd", "atkinson", "bayer")
+
+
+def bayer_matrix(n: int = 8) -> np.ndarray:
+    # n x n 的 Bayer 阈值矩阵(n 为 2 的幂), 取值 0 ~ n*n-1
+    m = np.zeros((1, 1), dtype=np.int32)
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return m
+
+
+_BAYER_THRESHOLD = ((bayer_matrix(8) + 0.5) / 64).astype(np.float32)
+
+
+def ordered_dither(gray: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # Bayer 有序抖动, 返回 values 的下标
+    # 先用查找表求出每个灰度落在哪两个相邻的目标灰度之间以及所占比例, 再与阈值矩阵比较, 全部向量化
+    g = np.arange(256, dtype=np.float32)
+    lower = np.clip(np.searchsorted(values, g, side="right") - 1, 0, len(values) - 2)
+    fraction = (g - values[lower]) / (values[lower + 1] - values[lower])
+    h, w = gray.shape
+    n = _BAYER_THRESHOLD.shape[0]
+    threshold = _BAYER_THRESHOLD[np.arange(h)[:, None] % n, np.arange(w) % n]
+    return (lower[gray] + (fraction[gray] > threshold)).astype(np.uint8)
+
+
+def error_diffusion(gray: np.ndarray, values: np.ndarray, kernel) -> np.ndarray:
+    # 误差扩散抖动, 返回 values 的下标
+    # 核只向右和向下扩散(最多 2 行, 右边最多 2 列), 所以 x + 2y 相同的一条斜线上的像素互不依赖,
+    # 按斜线逐条处理, 每条斜线内向量化, 结果与逐行逐像素处理相同, 但循环次数只有 w + 2h 次
+    h, w = gray.shape
+    pad = 2
+    stride = w + 2 * pad
+    # 在展平的缓冲区上用一维下标操作, 扩散到邻居只是加上固定的偏移
+    buf = np.zeros((h + pad, stride), dtype=np.float32)
+    buf[:h, pad:pad + w] = gray
+    buf = buf.ravel()
+    out = np.zeros((h + pad) * stride, dtype=np.uint8)
+    thresholds = (values[1:] + values[:-1]) / 2
+    offsets = [(dy * stride + dx, np.float32(weight)) for dy, dx, weight in kernel]
+    rows = np.arange(h)
+    for t in range(w + 2 * (h - 1)):
+        ys = rows[max(0, (t - w + 2) // 2):min(h - 1, t // 2) + 1]
+        pos = ys * (stride - 2) + t + pad
+        old = buf[pos]
+        index = np.searchsorted(thresholds, old)
+        out[pos] = index
+        error = old - values[index]
+        for offset, weight in offsets:
+            buf[pos + offset] += error * weight
+    return out.reshape(h + pad, stride)[:h, pad:pad + w]
+
+
+def dither_levels(gray: np.ndarray, dither: str, two_level: bool = False) -> np.ndarray:
+    # 把灰度图抖动到计算器调色板(0, 149, 186, 255), two_level 时只用黑白两色
+    if two_level:
+        values, levels = LEVEL_VALUES[[0, 3]], np.array([0, 3], dtype=np.uint8)
+    else:
+        values, levels = LEVEL_VALUES, np.arange(4, dtype=np.uint8)
+    if dither == "bayer":
+        index = ordered_dither(gray, values)
+    elif dither in DIFFUSION_KERNELS:
+        index = error_diffusion(gray, values, DIFFUSION_KERNELS[dither])
+    else:
+        raise ValueError(f"未知的抖动方式: {dither}")
+    return levels[index]
+
+
+def quantize(rgb: np.ndarray, method: str = "grayscale", dither: str = "none") -> np.ndarray:
+    # 灰度化为色阶索引, 抖动时标准四级灰度化先做自动对比度, 其他方式直接使用灰度
+    if dither == "none":
+        return QUANTIZERS[method](rgb)
+    if method not in QUANTIZERS:
+        raise KeyError(method)
+    gray = np.asarray(autocontrast_gray(rgb)) if method == "grayscale" else to_gray(rgb)
+    return dither_levels(gray, dither, method == "2level")
+
+
+def render(levels: np.ndarray, red_green: bool = False) -> np.ndarray:
+    # 色阶索引 -> RGB, 一次查表完成
+    palette = RED_GREEN_PALETTE if red_green else GRAY_PALETTE
+    return palette[levels]
+
+
+def pack_levels(levels: np.ndarray) -> bytes:
+    # 色阶索引按行打包为 2 位/像素, 每字节 4 个像素, 高位在前, 每行末尾不足的部分补 0
+    h, w = levels.shape
+    padded = np.zeros((h, -(-w // 4) * 4), dtype=np.uint8)
+    padded[:, :w] = levels
+    quads = padded.reshape(h, -1, 4)
+    return (quads[..., 0] << 6 | quads[..., 1] << 4 | quads[..., 2] << 2 | quads[..., 3]).tobytes()
+
+
+def unpack_levels(data: bytes, width: int, height: int) -> np.ndarray:
+    # pack_levels 的逆操作
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(height, -1)
+    quads = np.stack([packed >> 6, packed >> 4, packed >> 2, packed], axis=-1) & 3
+    return quads.reshape(height, -1)[:, :width]
+
+
+def red_green(rgb: np.ndarray) -> np.ndarray:
+    # 对任意 RGB 图像应用红绿模式(例如已经加了像素分割线或旋转过的图)
+    gray_mask = (rgb[..., 0] == rgb[..., 1]) & (rgb[..., 1] == rgb[..., 2])
+    return np.where(gray_mask[..., None], _RED_GREEN_LUT[rgb[..., 0]], rgb)
+
+
+def grid(rgb: np.ndarray, scale: int = GRID_SCALE, color: tuple = GRID_COLOR) -> np.ndarray:
+    # 放大 scale 倍并每隔 scale 个像素画一条分割线
+    out = np.repeat(np.repeat(rgb, scale, axis=0), scale, axis=1)
+    out[:, ::scale] = color
+    out[::scale, :] = color
+    return out
+
+
+def palette_levels(rgb: np.ndarray):
+    # 图片只包含某套调色板中的颜色时返回 (色阶索引, 是否红绿模式), 否则返回 None
+    keys = rgb.astype(np.uint32)
+    keys = keys[..., 0] << 16 | keys[..., 1] << 8 | keys[..., 2]
+    for is_red_green, palette in ((False, GRAY_PALETTE), (True, RED_GREEN_PALETTE)):
+        palette_keys = palette.astype(np.uint32)
+        palette_keys = palette_keys[:, 0] << 16 | palette_keys[:, 1] << 8 | palette_keys[:, 2]
+        order = np.argsort(palette_keys)
+        found = np.minimum(np.searchsorted(palette_keys, keys, sorter=order), len(order) - 1)
+        levels = order[found]
+        if (palette_keys[levels] == keys).all():
+            return levels.astype(np.uint8), is_red_green
+    return None
+
+
+def split_grid(rgb: np.ndarray):
+    # 判断是否为像素分割线图片, 是则返回 1 倍大小的原图
+    scale = GRID_SCALE
+    h, w = rgb.shape[:2]
+    if h % scale or w % scale:
+        return None
+    small = rgb[1::scale, 1::scale]
+    if np.array_equal(grid(small), rgb):
+        return small
+    return None
+
+
+def image_levels(rgb: np.ndarray):
+    # 从已经灰度化的图片还原出 (色阶索引, 是否红绿模式, 是否有像素分割线), 不是灰度化结果时返回 None
+    small = split_grid(rgb)
+    found = palette_levels(rgb if small is None else small)
+    if found is None:
+        return None
+    return found[0], found[1], small is not None
+
+
+class Pipeline(NamedTuple):
+    # 一次转换使用的全部参数
+    keep_ratio: bool = True  # 维持原比例
+    method: str = "grayscale"  # 灰度化方式, 见 QUANTIZERS
+    red_green_mode: bool = False  # 红绿模式
+    pixel_grid: bool = False  # 像素分割线
+    dither: str = "none"  # 抖动方式, 见 DITHERS
+    profile: str = DEFAULT_PROFILE  # 屏幕规格, 见 SCREEN_PROFILES
+
+
+# 流程描述中的关键字, 例如 "pixelate, keep ratio, cv2 4-level, red/green"
+_PIPELINE_WORDS = {
+    "pixelate": {}, "像素化": {},
+    "keep ratio": {"keep_ratio": True}, "维持原比例": {"keep_ratio": True},
+    "stretch": {"keep_ratio": False}, "no ratio": {"keep_ratio": False},
+    "4-level": {"method": "grayscale"}, "grayscale": {"method": "grayscale"}, "四级灰度化": {"method": "grayscale"},
+    "cv2 4-level": {"method": "cv2"}, "cv2": {"method": "cv2"}, "opencv四级灰度化": {"method": "cv2"},
+    "2-level": {"method": "2level"}, "2level": {"method": "2level"}, "二级灰度化": {"method": "2level"},
+    "red/green": {"red_green_mode": True}, "red-green": {"red_green_mode": True}, "红绿模式": {"red_green_mode": True},
+    "grid": {"pixel_grid": True}, "像素边框": {"pixel_grid": True}, "像素分割线": {"pixel_grid": True},
+    "floyd-steinberg": {"dither": "floyd"}, "floyd": {"dither": "floyd"}, "atkinson": {"dither": "atkinson"},
+    "bayer": {"dither": "bayer"}, "ordered": {"dither": "bayer"}, "no dither": {"dither": "none"},
+    "误差扩散抖动": {"dither": "floyd"}, "有序抖动": {"dither": "bayer"},
+    **{name: {"profile": name} for name in SCREEN_PROFILES},
+}
+
+
+def pipeline_options(spec: str) -> dict:
+    # 流程描述中写明的参数, 未写明的不在结果中
+    options = {}
+    for word in spec.split(","):
+        word = " ".join(word.lower().split())
+        if not word:
+            continue
+        if word not in _PIPELINE_WORDS:
+            raise ValueError(f"无法识别的处理步骤: {word}")
+        options.update(_PIPELINE_WORDS[word])
+    return options
+
+
+def parse_pipeline(spec: str) -> Pipeline:
+    # 把逗号分隔的流程描述解析为 Pipeline, 未写明的参数使用默认值
+    return Pipeline(**pipeline_options(spec))
+
+
+def process(rgb: np.ndarray, keep_ratio: bool = True, method: str = "grayscale",
+            red_green_mode: bool = False, pixel_grid: bool = False, dither: str = "none",
+            profile: str = DEFAULT_PROFILE) -> np.ndarray:
+    # 完整流程: 像素化 -> 灰度化(抖动) -> (红绿模式) -> (像素分割线)
+    levels = quantize(pixelate(rgb, keep_ratio, profile), method, dither)
+    out = render(levels, red_green_mode)
+    if pixel_grid:
+        out = grid(out)
+    return out
@@ -1,10 +1,174 @@
-from flask import Flask, render_template
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, render_template, request, jsonify, Response
+from PIL import Image
+
+import processing
+import loader
+import bitplane
+from cache import ResultCache, make_key
+import instrument
 
 app = Flask(__name__)
+# 上传大小上限
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('PIXEL_MAX_UPLOAD', 32 * 1024 * 1024))
+# 同时处理的请求数, 以及最多允许多少个请求排队等待
+app.config['PIXEL_WORKERS'] = int(os.environ.get('PIXEL_WORKERS', os.cpu_count() or 1))
+app.config['PIXEL_QUEUE_SIZE'] = int(os.environ.get('PIXEL_QUEUE_SIZE', 16))
+
+# 转换结果缓存, 设置 PIXEL_CACHE_DIR 时启用磁盘缓存
+cache = ResultCache(memory_bytes=int(os.environ.get('PIXEL_CACHE_MB', 64)) * 1024 * 1024,
+                    disk_dir=os.environ.get('PIXEL_CACHE_DIR') or None,
+                    disk_bytes=int(os.environ.get('PIXEL_CACHE_DISK_MB', 512)) * 1024 * 1024)
+
+# 各步骤耗时, 通过 Server-Timing 响应头返回, /api/profile 可以导出全部记录
+# 设置 PIXEL_PROFILE_MEMORY=1 时同时统计内存(会变慢, 并发时只能作为参考)
+profiler = instrument.Profiler(trace_memory=os.environ.get('PIXEL_PROFILE_MEMORY', '') in ('1', 'true', 'yes'))
+
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # 第一次使用时按配置创建线程池, PIL/numpy/opencv 处理时会释放 GIL
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is None:
+            workers = app.config['PIXEL_WORKERS']
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pixel')
+            _slots = threading.BoundedSemaphore(workers + app.config['PIXEL_QUEUE_SIZE'])
+        return _pool, _slots
+
+
+def parse_options(form):
+    # 表单参数 -> Pipeline, 既可以传 pipeline 描述, 也可以逐项传参数
+    if form.get('pipeline'):
+        pipeline = processing.parse_pipeline(form['pipeline'])
+    else:
+        pipeline = processing.Pipeline()
+    flags = {}
+    for name in ('keep_ratio', 'red_green_mode', 'pixel_grid'):
+        if name in form:
+            flags[name] = form[name].lower() in ('1', 'true', 'on', 'yes')
+    if 'method' in form:
+        if form['method'] not in processing.QUANTIZERS:
+            raise ValueError(f"未知的灰度化方式: {form['method']}")
+        flags['method'] = form['method']
+    if 'dither' in form:
+        if form['dither'] not in processing.DITHERS:
+            raise ValueError(f"未知的抖动方式: {form['dither']}")
+        flags['dither'] = form['dither']
+    if 'profile' in form:
+        if form['profile'] not in processing.SCREEN_PROFILES:
+            raise ValueError(f"未知的屏幕规格: {form['profile']}")
+        flags['profile'] = form['profile']
+    return pipeline._replace(**flags)
+
+
+def convert(data, pipeline, output):
+    with profiler.measure('decode'):
+        size = processing.screen_size(pipeline.profile)
+        rgb = processing.to_rgb_array(loader.load_image(data, size, rotatable=False).image)
+    with profiler.measure('pixelate'):
+        pixelated = processing.pixelate(rgb, pipeline.keep_ratio, pipeline.profile)
+    with profiler.measure('quantize'):
+        levels = processing.quantize(pixelated, pipeline.method, pipeline.dither)
+    with profiler.measure('encode'):
+        # 打包格式只保存色阶, 红绿模式和像素分割线只影响显示
+        if output == 'cgb':
+            return bitplane.encode(levels)
+        if output == 'packed':
+            return processing.pack_levels(levels)
+        out = processing.render(levels, pipeline.red_green_mode)
+        if pipeline.pixel_grid:
+            out = processing.grid(out)
+        buffer = io.BytesIO()
+        Image.fromarray(out).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+
+def convert_timed(data, pipeline, output):
+    # 在线程池中转换, 同时返回这次转换各步骤的记录
+    with profiler.collect() as spans:
+        with profiler.measure('convert'):
+            result = convert(data, pipeline, output)
+    return result, spans
+
+
+def make_response(result, output, cache_status, size, spans=()):
+    # size 为屏幕 (宽, 高), 打包结果没有文件头, 宽高放在响应头中
+    headers = {'X-Cache': cache_status}
+    if spans:
+        headers['Server-Timing'] = instrument.server_timing(spans)
+        # 最后一条是整个请求, 统计内存时附上新增内存峰值
+        if spans[-1].alloc_bytes is not None:
+            headers['X-Alloc-Bytes'] = str(spans[-1].alloc_bytes)
+    if output == 'packed':
+        headers.update({'X-Width': str(size[0]), 'X-Height': str(size[1]),
+                        'X-Bits-Per-Pixel': '2'})
+        return Response(result, mimetype='application/octet-stream', headers=headers)
+    if output == 'cgb':
+        # 计算器位图, 宽高写在文件头中
+        return Response(result, mimetype='application/octet-stream', headers=headers)
+    return Response(result, mimetype='image/png', headers=headers)
+
 
 @app.route('/')
 def index():
     return render_template('pixel_processor.html')
 
+
+@app.route('/api/convert', methods=['POST'])
+def api_convert():
+    upload = request.files.get('image')
+    if upload is None:
+        return jsonify(error='缺少 image 文件'), 400
+    output = request.form.get('format', 'png')
+    if output not in ('png', 'packed', 'cgb'):
+        return jsonify(error=f'未知的输出格式: {output}'), 400
+    try:
+        pipeline = parse_options(request.form)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    data = upload.read()
+    with profiler.collect() as spans:
+        with profiler.measure('cache'):
+            key = make_key(data, pipeline, output)
+            result = cache.get(key)
+    if result is not None:
+        return make_response(result, output, 'hit', processing.screen_size(pipeline.profile), spans)
+
+    pool, slots = get_pool()
+    # 排队已满时直接返回 429, 不再堆积请求
+    if not slots.acquire(blocking=False):
+        return jsonify(error='服务器繁忙, 请稍后重试'), 429, {'Retry-After': '1'}
+    try:
+        result, convert_spans = pool.submit(convert_timed, data, pipeline, output).result()
+    except (OSError, Image.DecompressionBombError) as e:
+        return jsonify(error=f'无法读取图片: {e}'), 400
+    finally:
+        slots.release()
+    cache.put(key, result)
+    return make_response(result, output, 'miss', processing.screen_size(pipeline.profile), spans + convert_spans)
+
+
+@app.route('/api/cache', methods=['GET'])
+def api_cache():
+    return jsonify(dict(cache.stats, hit_rate=cache.hit_rate()))
+
+
+@app.route('/api/profile', methods=['GET'])
+def api_profile():
+    # ?format=trace 返回 Chrome trace, 可以用 chrome://tracing 或 Perfetto 打开; 否则返回记录和汇总
+    if request.args.get('format') == 'trace':
+        return jsonify(profiler.to_chrome_trace())
+    return jsonify(profiler.to_json())
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,82 @@
+"""
+按阶段缓存的处理流程
+
+把 像素化 -> 灰度化(抖动) -> 上色 看作一串阶段, 每个阶段的结果以"它和所有上游阶段的参数"为键缓存,
+修改某个参数时只有它所在的阶段及其下游需要重新计算:
+- 开关红绿模式只是换一套调色板查表, 色阶直接取缓存
+- 换灰度化或抖动方式时复用缓存中像素化好的图
+- 切换维持原比例时从原图重新像素化, 来回切换时两种结果都已在缓存中
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+import processing
+
+
+def _pixelate(source, pipeline):
+    if not isinstance(source, np.ndarray):
+        source = processing.to_rgb_array(source)
+    return processing.pixelate(source, pipeline.keep_ratio, pipeline.profile)
+
+
+# (阶段名, 该阶段用到的 Pipeline 参数, 计算函数(上一阶段的结果, Pipeline))
+STAGES = (
+    ("pixelate", ("keep_ratio", "profile"), _pixelate),
+    ("quantize", ("method", "dither"), lambda rgb, p: processing.quantize(rgb, p.method, p.dither)),
+    ("render", ("red_green_mode",), lambda levels, p: processing.render(levels, p.red_green_mode)),
+)
+STAGE_NAMES = tuple(stage[0] for stage in STAGES)
+
+
+class StagePipeline:
+    def __init__(self, max_entries=16):
+        # max_entries: 所有阶段合计最多缓存的结果数, 192x63 的结果每个只有几十 KB
+        self.max_entries = max_entries
+        self.source = None
+        self._memo = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def set_source(self, source):
+        # source 为 PIL 图片或 RGB 数组; 换了原图时清空全部缓存, 同一个对象则保留
+        if source is not self.source:
+            self.source = source
+            self._memo.clear()
+
+    def seed(self, stage, pipeline, value):
+        # 直接放入某一阶段的结果, 例如撤销后恢复出来的像素化图片
+        self._put(self._key(stage, pipeline), value)
+
+    def run(self, pipeline, stage="render"):
+        # 返回 pipeline 对应的 stage 阶段结果, 只计算缓存中没有的阶段
+        key = self._key(stage, pipeline)
+        if key in self._memo:
+            self.stats["hits"] += 1
+            self._memo.move_to_end(key)
+            return self._memo[key]
+        self.stats["misses"] += 1
+        index = STAGE_NAMES.index(stage)
+        if index == 0:
+            if self.source is None:
+                raise ValueError("没有可以处理的原图")
+            upstream = self.source
+        else:
+            upstream = self.run(pipeline, STAGE_NAMES[index - 1])
+        value = STAGES[index][2](upstream, pipeline)
+        self._put(key, value)
+        return value
+
+    def _key(self, stage, pipeline):
+        # 阶段名 + 该阶段及所有上游阶段的参数
+        params = []
+        for name, fields, _ in STAGES:
+            params.extend(getattr(pipeline, field) for field in fields)
+            if name == stage:
+                return (stage,) + tuple(params)
+        raise ValueError(f"未知的处理阶段: {stage}")
+
+    def _put(self, key, value):
+        self._memo[key] = value
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.max_entries:
+            self._memo.popitem(last=False)
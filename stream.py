@@ -0,0 +1,169 @@
+"""
+动图/视频逐帧转换
+
+以生成器串联 读取 -> 像素化 -> 灰度化 -> 去掉连续重复帧 -> 写出,
+任何时候内存中只有一两帧, 再长的视频也不会占满内存
+
+用法示例:
+    python stream.py clip.gif -o clip.cpa
+    python stream.py movie.mp4 -o frames/ -p "pixelate, keep ratio, 2-level"
+
+.cpa 动画文件格式(小端):
+    头部 16 字节: b"CPA1", uint16 宽, uint16 高, uint8 每像素位数(2), 3 字节保留, uint32 帧数
+    每一帧: uint32 显示时长(毫秒), 然后是 processing.pack_levels 打包的色阶(每行 ceil(宽/4) 字节)
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import processing
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".m4v", ".webm")
+
+ANIMATION_MAGIC = b"CPA1"
+_HEADER = struct.Struct("<4sHHB3xI")
+_FRAME = struct.Struct("<I")
+
+
+def read_frames(path):
+    # 逐帧读取, 生成 (RGB 数组, 显示时长毫秒)
+    if path.lower().endswith(VIDEO_EXTENSIONS):
+        yield from _read_video(path)
+        return
+    with Image.open(path) as img:
+        for frame in ImageSequence.Iterator(img):
+            yield processing.to_rgb_array(frame), frame.info.get("duration", img.info.get("duration", 100)) or 100
+
+
+def _read_video(path):
+    # 只有转换视频时才导入 opencv, 转换动图不需要
+    import cv2
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise OSError(f"无法打开视频: {path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    duration = round(1000 / fps)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            # opencv 读出的是 BGR
+            yield frame[..., ::-1], duration
+    finally:
+        capture.release()
+
+
+def convert_frames(frames, pipeline):
+    # 像素化并灰度化, 生成 (色阶索引, 显示时长)
+    # 像素化结果马上就被灰度化用掉, 所有帧共用同一块缓冲区; 同样大小的帧共用同一个缩放计划
+    width, height = processing.screen_size(pipeline.profile)
+    pixelated = np.empty((height, width, 3), dtype=np.uint8)
+    for rgb, duration in frames:
+        processing.pixelate(rgb, pipeline.keep_ratio, pipeline.profile, out=pixelated)
+        yield processing.quantize(pixelated, pipeline.method, pipeline.dither), duration
+
+
+def drop_duplicates(frames):
+    # 合并连续相同的帧, 时长累加到保留下来的那一帧上
+    previous = None
+    total = 0
+    for levels, duration in frames:
+        if previous is not None and np.array_equal(levels, previous):
+            total += duration
+            continue
+        if previous is not None:
+            yield previous, total
+        previous, total = levels, duration
+    if previous is not None:
+        yield previous, total
+
+
+def write_animation(path, frames):
+    # 写出 .cpa 动画文件, 帧大小以第一帧为准, 大小和帧数在写完后回填
+    count = 0
+    shape = (processing.SCREEN_HEIGHT, processing.SCREEN_WIDTH)
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(ANIMATION_MAGIC, shape[1], shape[0], 2, 0))
+        for levels, duration in frames:
+            if count == 0:
+                shape = levels.shape
+            elif levels.shape != shape:
+                raise ValueError(f"帧大小不是 {shape[1]}x{shape[0]}")
+            f.write(_FRAME.pack(min(duration, 0xFFFFFFFF)))
+            f.write(processing.pack_levels(levels))
+            count += 1
+        f.seek(0)
+        f.write(_HEADER.pack(ANIMATION_MAGIC, shape[1], shape[0], 2, count))
+    return count
+
+
+def read_animation(path):
+    # 读取 .cpa 动画文件, 逐帧生成 (色阶索引, 显示时长)
+    with open(path, "rb") as f:
+        magic, width, height, bits, count = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != ANIMATION_MAGIC or bits != 2:
+            raise ValueError("不是有效的 .cpa 动画文件")
+        frame_bytes = height * -(-width // 4)
+        for _ in range(count):
+            (duration,) = _FRAME.unpack(f.read(_FRAME.size))
+            yield processing.unpack_levels(f.read(frame_bytes), width, height), duration
+
+
+def write_sequence(out_dir, frames, pipeline):
+    # 按顺序写出 PNG 帧序列, 文件名中带上显示时长
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0
+    for levels, duration in frames:
+        rgb = processing.render(levels, pipeline.red_green_mode)
+        if pipeline.pixel_grid:
+            rgb = processing.grid(rgb)
+        Image.fromarray(rgb).save(os.path.join(out_dir, f"{count:06d}_{duration}ms.png"))
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="将动图或视频逐帧转换为计算器屏幕格式")
+    parser.add_argument("input", help="GIF/WebP 动图或视频文件")
+    parser.add_argument("-o", "--output", required=True, help="以 .cpa 结尾时写出动画文件, 否则写出 PNG 帧序列到该目录")
+    parser.add_argument("-p", "--pipeline", default="pixelate, keep ratio, cv2 4-level",
+                        help='处理流程, 例如 "pixelate, keep ratio, 2-level, 384x216"')
+    parser.add_argument("--keep-duplicates", action="store_true", help="保留连续重复的帧")
+    args = parser.parse_args(argv)
+
+    try:
+        pipeline = processing.parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # 统计读入的帧数
+    read_count = 0
+
+    def counted(frames):
+        nonlocal read_count
+        for frame in frames:
+            read_count += 1
+            yield frame
+
+    start = time.perf_counter()
+    frames = convert_frames(counted(read_frames(args.input)), pipeline)
+    if not args.keep_duplicates:
+        frames = drop_duplicates(frames)
+    if args.output.lower().endswith(".cpa"):
+        written = write_animation(args.output, frames)
+    else:
+        written = write_sequence(args.output, frames, pipeline)
+    elapsed = time.perf_counter() - start
+    print(f"读入 {read_count} 帧, 写出 {written} 帧, 用时 {elapsed:.2f} s, "
+          f"{read_count / elapsed if elapsed else 0:.1f} 帧/秒")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+一次解码, 输出多种版本
+
+审图时经常要同一张图的四级灰度、opencv 四级灰度、二级灰度、红绿模式、像素分割线等好几个版本,
+逐个转换要重复解码和像素化; 这里只解码一次, 用分阶段缓存(见 stages.py)让各版本共用
+同一个像素化结果和灰度化结果, 最后的上色和编码在线程池中并行进行(Pillow 和 zlib 编码时会释放 GIL)
+
+用法示例:
+    python variants.py photo.jpg -o preview/
+    python variants.py photo.jpg -o preview/ --profiles 192x63,128x64 -f cgb
+    python variants.py photo.jpg -o preview/ -v "cv2 4-level, floyd" -v "2-level, bayer"
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from PIL import Image
+
+import processing
+import loader
+import bitplane
+from cache import normalize_pipeline
+from stages import StagePipeline
+
+FORMATS = ("png", "bmp", "jpg", "cgb")
+
+
+class Variant(NamedTuple):
+    label: str  # 用于输出文件名
+    pipeline: processing.Pipeline
+    fmt: str = "png"
+
+
+# 默认输出的预览版本
+PREVIEW_SET = (
+    ("4level", "4-level"),
+    ("cv2", "cv2 4-level"),
+    ("2level", "2-level"),
+    ("red-green", "4-level, red/green"),
+    ("cv2-red-green", "cv2 4-level, red/green"),
+    ("grid", "4-level, grid"),
+)
+
+
+def make_variants(specs=PREVIEW_SET, profiles=(processing.DEFAULT_PROFILE,), fmt="png", keep_ratio=True):
+    # (名称, 处理流程描述) 列表与屏幕规格两两组合, 有多个屏幕规格时名称后面加上规格
+    # keep_ratio 和 profiles 只用于流程描述中没有写明的参数, 写明了屏幕规格的流程只输出这一种规格
+    variants = []
+    for label, spec in specs:
+        options = processing.pipeline_options(spec)
+        options.setdefault("keep_ratio", keep_ratio)
+        for profile in ((options["profile"],) if "profile" in options else profiles):
+            pipeline = processing.Pipeline(**dict(options, profile=profile))
+            name = label
+            if (len(profiles) > 1 or profile not in profiles) and not label.endswith(profile):
+                name = f"{label}-{profile}"
+            variants.append(Variant(name, pipeline, fmt))
+    return variants
+
+
+def drop_duplicates(variants):
+    # 去掉输出必然相同的版本, 返回 (保留的版本, [(去掉的名称, 与之相同的名称)])
+    # cgb 只保存色阶索引, 红绿模式和像素分割线都不起作用; 二级灰度的红绿模式也不起作用
+    kept, dropped = [], []
+    labels = {}
+    for variant in variants:
+        pipeline = variant.pipeline
+        if variant.fmt == "cgb":
+            pipeline = pipeline._replace(red_green_mode=False, pixel_grid=False)
+        same = labels.setdefault((normalize_pipeline(pipeline), variant.fmt), variant.label)
+        if same != variant.label:
+            dropped.append((variant.label, same))
+        else:
+            kept.append(variant)
+    return kept, dropped
+
+
+def decode_size(variants) -> tuple:
+    # 所有版本都够用的解码大小
+    sizes = [processing.screen_size(variant.pipeline.profile) for variant in variants]
+    return max(w for w, _ in sizes), max(h for _, h in sizes)
+
+
+def encode_variant(value, variant: Variant) -> bytes:
+    # value 为灰度化结果(色阶索引, 输出 cgb 时)或上色后的 RGB 数组
+    if variant.fmt == "cgb":
+        return bitplane.encode(value)
+    if variant.pipeline.pixel_grid:
+        value = processing.grid(value)
+    buffer = io.BytesIO()
+    Image.fromarray(value).save(buffer, format="JPEG" if variant.fmt == "jpg" else variant.fmt.upper())
+    return buffer.getvalue()
+
+
+def render_variants(source, variants, workers=None) -> dict:
+    # source 为 RGB 数组或 PIL 图片, 返回 {名称: 编码后的字节}
+    # 各阶段按顺序在当前线程计算(192x63 的灰度化只要几毫秒, 且大多可以共用), 编码交给线程池
+    stages = StagePipeline(max_entries=3 * len(variants))
+    stages.set_source(processing.to_rgb_array(source) if isinstance(source, Image.Image) else source)
+    with ThreadPoolExecutor(max_workers=workers or min(len(variants), os.cpu_count() or 1) or 1) as executor:
+        futures = {}
+        for variant in variants:
+            if variant.label in futures:
+                raise ValueError(f"重复的版本名称: {variant.label}")
+            value = stages.run(variant.pipeline, "quantize" if variant.fmt == "cgb" else "render")
+            futures[variant.label] = executor.submit(encode_variant, value, variant)
+        return {label: future.result() for label, future in futures.items()}
+
+
+def encode_variants(data: bytes, variants, workers=None) -> dict:
+    # 源文件字节 -> {名称: 编码后的字节}, 只解码一次
+    image = loader.load_image(data, decode_size(variants), rotatable=False).image
+    return render_variants(processing.to_rgb_array(image), variants, workers)
+
+
+def parse_profiles(text):
+    profiles = tuple(p.strip() for p in text.split(",") if p.strip())
+    for profile in profiles:
+        processing.screen_size(profile)
+    return profiles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="一次解码, 输出同一张图片的多种处理版本")
+    parser.add_argument("inputs", nargs="+", help="图片文件")
+    parser.add_argument("-o", "--output", required=True, help="输出目录, 文件名为 <原文件名>-<版本>.<格式>")
+    parser.add_argument("-v", "--variant", action="append", default=None,
+                        help='处理流程, 可以重复指定, 例如 -v "cv2 4-level, floyd"; 不指定时输出默认的预览版本')
+    parser.add_argument("--profiles", default=processing.DEFAULT_PROFILE,
+                        help="屏幕规格, 逗号分隔, 例如 192x63,128x64,384x216; 处理流程中写明了规格的不受影响")
+    parser.add_argument("--stretch", action="store_true", help="不维持原比例, 处理流程中写明了的不受影响")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="png", help="输出格式")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="编码线程数")
+    args = parser.parse_args(argv)
+
+    try:
+        specs = PREVIEW_SET
+        if args.variant:
+            specs = [(spec.replace(",", "").replace("/", "-").replace(" ", "-"), spec) for spec in args.variant]
+        variants = make_variants(specs, parse_profiles(args.profiles), args.format, not args.stretch)
+    except ValueError as e:
+        parser.error(str(e))
+    variants, dropped = drop_duplicates(variants)
+    for label, same in dropped:
+        reason = "cgb 不保存红绿模式和像素分割线" if args.format == "cgb" else "二级灰度没有红绿模式"
+        print(f"跳过 {label}: 输出与 {same} 相同 ({reason})")
+
+    os.makedirs(args.output, exist_ok=True)
+    failed = 0
+    for source in args.inputs:
+        start = time.perf_counter()
+        try:
+            with open(source, "rb") as f:
+                outputs = encode_variants(f.read(), variants, args.workers)
+        except Exception as e:
+            failed += 1
+            print(f"[fail] {source}: {type(e).__name__}: {e}", file=sys.stderr)
+            continue
+        stem = os.path.splitext(os.path.basename(source))[0]
+        for label, encoded in outputs.items():
+            with open(os.path.join(args.output, f"{stem}-{label}.{args.format}"), "wb") as f:
+                f.write(encoded)
+        print(f"{source}: {len(outputs)} 个版本 ({(time.perf_counter() - start) * 1000:.1f} ms)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
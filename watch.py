@@ -0,0 +1,203 @@
+"""
+监视目录, 增量转换
+
+每一轮扫描源目录, 与输出目录中的清单(.manifest.json)比较:
+- 新增或修改过的图片重新转换, 大小和修改时间没变的直接跳过
+- 修改时间变了但内容(sha256)没变的只更新清单, 不重新转换
+- 处理参数或输出格式变了的全部重新转换
+- 转换失败的图片记下失败时的大小、修改时间和哈希, 文件改动之前不再重试
+- 已删除的图片同时删除它的输出文件, 其他图片仍在使用的输出除外
+只用定时轮询, 不依赖任何文件系统通知, 在哪里都能运行
+
+用法示例:
+    python watch.py art/ -o out/ -p "pixelate, keep ratio, cv2 4-level" --interval 2
+    python watch.py art/ -o out/ -f cgb --once
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import processing
+from batch import collect_sources, convert_file, output_path
+from cache import normalize_pipeline
+
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_hash(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(out_dir) -> dict:
+    # 清单不存在或无法读取时当作空清单, 全部重新转换
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("sources", {})
+
+
+def save_manifest(out_dir, sources):
+    # 先写临时文件再替换, 中途退出也不会留下写了一半的清单
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "sources": sources}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST_NAME))
+
+
+def plan_pass(sources, out_dir, manifest, options, fmt):
+    # 比较扫描结果与清单, 返回 (需要转换的, 跳过的, 已删除的, 新清单)
+    # sources 为 (源文件, 相对路径) 列表; 新清单中需要转换的图片先不写入, 转换成功后再补上
+    # 两张源图片对应同一个输出文件时报错, 否则它们会互相覆盖
+    convert, skipped = [], []
+    updated = {}
+    destinations = {}
+    for source, relative in sources:
+        st = os.stat(source)
+        destination = output_path(out_dir, relative, fmt)
+        other = destinations.setdefault(os.path.normcase(destination), source)
+        if other != source:
+            raise ValueError(f"输出文件名冲突: {other} 和 {source} 都输出到 {destination}")
+        entry = manifest.get(relative)
+        if entry and "error" in entry and entry["options"] == options:
+            # 上次转换失败的图片, 文件没有变化时不再重试
+            if entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                skipped.append((source, "上次转换失败"))
+                updated[relative] = entry
+                continue
+            if entry["size"] == st.st_size and entry["sha256"] == file_hash(source):
+                skipped.append((source, "上次转换失败"))
+                updated[relative] = dict(entry, mtime_ns=st.st_mtime_ns)
+                continue
+        elif (entry and entry["options"] == options and entry["output"] == destination
+                and os.path.exists(destination)):
+            if entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                skipped.append((source, "未修改"))
+                updated[relative] = entry
+                continue
+            if entry["size"] == st.st_size and entry["sha256"] == file_hash(source):
+                skipped.append((source, "内容未变"))
+                updated[relative] = dict(entry, mtime_ns=st.st_mtime_ns)
+                continue
+        # 转换前先记下内容的哈希, 转换期间文件又被修改时, 下一轮能发现哈希不同
+        convert.append((source, relative, destination, st, file_hash(source)))
+    present = {relative for _, relative in sources}
+    removed = [(relative, entry) for relative, entry in manifest.items() if relative not in present]
+    return convert, skipped, removed, updated
+
+
+def run_pass(inputs, out_dir, pipeline, fmt="png", workers=None, report=print, verbose=False):
+    # 执行一轮增量转换, 返回各类文件数
+    options = f"{normalize_pipeline(pipeline)};{fmt}"
+    out_root = os.path.abspath(out_dir)
+    # 输出目录在源目录里面时不要把输出当作源图片
+    sources = [(source, relative) for source, relative in collect_sources(inputs)
+               if not os.path.abspath(source).startswith(out_root + os.sep)]
+    manifest = load_manifest(out_dir)
+    convert, skipped, removed, updated = plan_pass(sources, out_dir, manifest, options, fmt)
+
+    failed = 0
+    # 仍有图片输出到的文件不能删除(例如改名后的源图片恰好用了同一个输出文件名)
+    in_use = {os.path.normcase(output_path(out_dir, relative, fmt)) for _, relative in sources}
+    in_use.update(os.path.normcase(entry["output"]) for entry in updated.values())
+    for relative, entry in removed:
+        if os.path.normcase(entry["output"]) in in_use:
+            report(f"[del]  {relative} (输出 {entry['output']} 仍在使用, 保留)")
+            continue
+        try:
+            os.remove(entry["output"])
+        except FileNotFoundError:
+            pass
+        report(f"[del]  {relative} -> {entry['output']}")
+
+    if convert:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(convert))) as executor:
+            futures = [(relative, st, digest, executor.submit(convert_file, source, destination, pipeline, fmt))
+                       for source, relative, destination, st, digest in convert]
+            for relative, st, digest, future in futures:
+                source, destination, error, _, elapsed = future.result()
+                previous = manifest.get(relative)
+                if error is not None:
+                    failed += 1
+                    report(f"[fail] {source}: {error}")
+                    # 记下失败时的文件状态, 文件改动之前不再重试; 输出仍指向上一次成功转换的结果,
+                    # 源图片之后被删除时仍能找到旧的输出
+                    updated[relative] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": digest,
+                                         "options": options,
+                                         "output": previous["output"] if previous else destination,
+                                         "error": error}
+                    continue
+                # 换了输出格式时删除旧格式的输出
+                if (previous and previous["output"] != destination and os.path.exists(previous["output"])
+                        and os.path.normcase(previous["output"]) not in in_use):
+                    os.remove(previous["output"])
+                updated[relative] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": digest,
+                                     "options": options, "output": destination}
+                report(f"[ok]   {source} -> {destination} ({elapsed * 1000:.1f} ms)")
+    if verbose:
+        for source, reason in skipped:
+            report(f"[skip] {source} ({reason})")
+
+    if convert or removed or updated != manifest:
+        save_manifest(out_dir, updated)
+    return {"converted": len(convert) - failed, "failed": failed, "skipped": len(skipped), "removed": len(removed)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="监视目录, 只转换新增或修改过的图片")
+    parser.add_argument("inputs", nargs="+", help="图片目录或通配符")
+    parser.add_argument("-o", "--output", required=True, help="输出目录, 清单保存在其中的 " + MANIFEST_NAME)
+    parser.add_argument("-p", "--pipeline", default="pixelate, keep ratio, 4-level",
+                        help='处理流程, 例如 "pixelate, keep ratio, cv2 4-level, red/green"')
+    parser.add_argument("-f", "--format", default="png", choices=["png", "bmp", "jpg", "cgb"], help="输出格式")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数, 默认等于 CPU 核心数")
+    parser.add_argument("--interval", type=float, default=2.0, help="轮询间隔(秒)")
+    parser.add_argument("--once", action="store_true", help="只执行一轮, 不持续监视")
+    parser.add_argument("-v", "--verbose", action="store_true", help="列出每个跳过的文件")
+    args = parser.parse_args(argv)
+
+    try:
+        pipeline = processing.parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                summary = run_pass(args.inputs, args.output, pipeline, args.format, args.workers,
+                                   verbose=args.verbose)
+            except ValueError as e:
+                # 输出文件名冲突时这一轮不做任何改动, 改名或移走冲突的图片后下一轮继续
+                print(f"{time.strftime('%H:%M:%S')} {e}", file=sys.stderr)
+                if args.once:
+                    return 2
+                time.sleep(args.interval)
+                continue
+            if args.once or summary["converted"] or summary["failed"] or summary["removed"]:
+                print(f"{time.strftime('%H:%M:%S')} 转换 {summary['converted']}, 失败 {summary['failed']}, "
+                      f"跳过 {summary['skipped']}, 删除 {summary['removed']}, "
+                      f"用时 {time.perf_counter() - start:.2f} s")
+            if args.once:
+                return 1 if summary["failed"] else 0
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())